@@ -0,0 +1,274 @@
+"""
+FSORT: Parallel block gzip (BGZF) reading and writing
+
+BGZF files are a series of independent gzip members, each holding up to 64kB
+of data with its compressed size recorded in a header extra field. Any gzip
+reader can decompress them as normal, but the blocks can also be compressed
+and decompressed in parallel because each one stands alone.
+"""
+import bisect
+import concurrent.futures
+import io
+import logging
+import os
+import struct
+import threading
+import zlib
+
+from nibabel.openers import Opener
+
+LOG = logging.getLogger(__name__)
+
+# Maximum uncompressed data per block, as used by htslib so that even
+# incompressible data fits within the 64kB block size limit
+BLOCK_SIZE = 0xFF00
+
+# gzip header with the FEXTRA flag and a single 'BC' subfield holding the block size - 1
+HEADER = struct.Struct("<4BI2BH2BHH")
+HEADER_PREFIX = b"\x1f\x8b\x08\x04"
+BC_SUBFIELD = b"\x06\x00BC\x02\x00"
+FOOTER = struct.Struct("<II")
+
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# Block offset index sidecar extension and format, as used by bgzip. The index
+# holds the (compressed, uncompressed) offsets of every block after the first
+INDEX_EXT = ".gzi"
+INDEX_COUNT = struct.Struct("<Q")
+INDEX_ENTRY = struct.Struct("<QQ")
+
+def _available_cpus():
+    """
+    :return: Number of CPUs this process may run on, which on a cluster may be far fewer than the node has
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+# Number of threads used for compression and decompression. Change with set_threads()
+THREADS = _available_cpus()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def set_threads(threads):
+    """
+    Set the number of threads used for compression and decompression
+
+    :param threads: Maximum number of threads. Capped at the number of CPUs available to the process
+    """
+    global THREADS, _executor
+    with _executor_lock:
+        THREADS = max(1, min(threads, _available_cpus()))
+        if _executor is not None:
+            # Jobs already submitted still complete
+            _executor.shutdown(wait=False)
+            _executor = None
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(THREADS)
+        return _executor
+
+def _valid_header(header):
+    return len(header) == HEADER.size and header.startswith(HEADER_PREFIX) and header[10:16] == BC_SUBFIELD
+
+def _compress_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = HEADER.pack(0x1F, 0x8B, 8, 4, 0, 0, 0xFF, 6, ord("B"), ord("C"), 2, HEADER.size + len(cdata) + FOOTER.size - 1)
+    return header + cdata + FOOTER.pack(zlib.crc32(data), len(data))
+
+def _decompress_block(block):
+    data = zlib.decompress(block[HEADER.size:-FOOTER.size], -15)
+    crc, isize = FOOTER.unpack(block[-FOOTER.size:])
+    if zlib.crc32(data) != crc or len(data) != isize:
+        raise ValueError("BGZF block failed CRC check")
+    return data
+
+class BgzfWriter(io.RawIOBase):
+    """
+    Write-only file object which compresses data as BGZF using a thread pool
+
+    Only forward seeks to the current position are supported, which is enough
+    for nibabel to write images through it
+    """
+
+    def __init__(self, fpath, level=None, index=False):
+        """
+        :param fpath: Output file path
+        :param level: zlib compression level. Defaults to nibabel's default for .nii.gz files
+        :param index: If True, also write a block offset index to fpath + INDEX_EXT
+        """
+        super().__init__()
+        self._file = open(fpath, "wb")
+        self._index_fpath = fpath + INDEX_EXT if index else None
+        self._level = level if level is not None else Opener.default_compresslevel
+        self._buffer = bytearray()
+        self._pending = []
+        self._pos = 0
+        self._offsets = [(0, 0)]
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        self._buffer += data
+        self._pos += len(data)
+        while len(self._buffer) >= BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:BLOCK_SIZE]))
+            del self._buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence != 0 or offset != self._pos:
+            raise OSError("BGZF output does not support seeking")
+        return self._pos
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._write_block()
+            self._file.write(EOF_BLOCK)
+        finally:
+            self._file.close()
+            super().close()
+        if self._index_fpath is not None:
+            write_index(self._index_fpath, self._offsets[:-1])
+
+    def _submit(self, data):
+        self._pending.append((_get_executor().submit(_compress_block, data, self._level), len(data)))
+        # Limit the number of blocks held in memory
+        while len(self._pending) > 4 * THREADS:
+            self._write_block()
+
+    def _write_block(self):
+        job, size = self._pending.pop(0)
+        block = job.result()
+        self._file.write(block)
+        coffset, uoffset = self._offsets[-1]
+        self._offsets.append((coffset + len(block), uoffset + size))
+
+def is_bgzf(fpath):
+    """
+    :return: True if fpath appears to be a BGZF file
+    """
+    try:
+        with open(fpath, "rb") as f:
+            header = f.read(HEADER.size)
+    except OSError:
+        return False
+    return _valid_header(header)
+
+def read(fpath):
+    """
+    Decompress a BGZF file using a thread pool
+
+    :return: Decompressed data as bytes, or None if fpath is not a valid BGZF file
+    """
+    with open(fpath, "rb") as f:
+        cdata = f.read()
+
+    blocks, offset = [], 0
+    while offset < len(cdata):
+        header = cdata[offset:offset+HEADER.size]
+        if not _valid_header(header):
+            return None
+        block_size = HEADER.unpack(header)[-1] + 1
+        blocks.append(memoryview(cdata)[offset:offset+block_size])
+        offset += block_size
+
+    try:
+        return b"".join(_get_executor().map(_decompress_block, blocks))
+    except (zlib.error, ValueError):
+        LOG.warn(f" - Failed to decompress {fpath} as BGZF")
+        return None
+
+def write_index(index_fpath, offsets):
+    """
+    Write a block offset index
+
+    :param offsets: Sequence of (compressed, uncompressed) offsets of each block, starting with (0, 0)
+    """
+    with open(index_fpath, "wb") as f:
+        f.write(INDEX_COUNT.pack(len(offsets) - 1))
+        for coffset, uoffset in offsets[1:]:
+            f.write(INDEX_ENTRY.pack(coffset, uoffset))
+
+def read_index(index_fpath):
+    """
+    :return: List of (compressed, uncompressed) offsets of each block, starting with (0, 0)
+    """
+    with open(index_fpath, "rb") as f:
+        data = f.read()
+    count = INDEX_COUNT.unpack_from(data)[0]
+    if len(data) != INDEX_COUNT.size + count * INDEX_ENTRY.size:
+        raise ValueError(f"Invalid BGZF index {index_fpath}")
+    return [(0, 0)] + list(INDEX_ENTRY.iter_unpack(data[INDEX_COUNT.size:]))
+
+def build_index(fpath):
+    """
+    Build the block offset index for an existing BGZF file
+
+    Only the block headers and footers are read so no decompression is needed
+
+    :return: List of (compressed, uncompressed) offsets of each block, starting with (0, 0)
+    """
+    offsets, coffset, uoffset = [], 0, 0
+    with open(fpath, "rb") as f:
+        while True:
+            header = f.read(HEADER.size)
+            if not header:
+                break
+            if not _valid_header(header):
+                raise ValueError(f"{fpath} is not a valid BGZF file")
+            block_size = HEADER.unpack(header)[-1] + 1
+            f.seek(block_size - HEADER.size - FOOTER.size, io.SEEK_CUR)
+            _crc, isize = FOOTER.unpack(f.read(FOOTER.size))
+            if isize > 0:
+                # Leave out empty blocks, e.g. the end of file marker
+                offsets.append((coffset, uoffset))
+            coffset += block_size
+            uoffset += isize
+    return offsets or [(0, 0)]
+
+def read_range(fpath, offsets, start, length):
+    """
+    Read part of the decompressed data of a BGZF file
+
+    Only the blocks containing the requested range are decompressed, in parallel
+
+    :param offsets: Block offset index as returned by read_index() or build_index()
+    :param start: Start position in decompressed data
+    :param length: Number of bytes to read
+    :return: Decompressed data as bytes
+    """
+    uoffsets = [uoffset for _coffset, uoffset in offsets]
+    first = bisect.bisect_right(uoffsets, start) - 1
+    last = bisect.bisect_left(uoffsets, start + length)
+    blocks = []
+    with open(fpath, "rb") as f:
+        for coffset, _uoffset in offsets[first:last]:
+            f.seek(coffset)
+            header = f.read(HEADER.size)
+            if not _valid_header(header):
+                raise ValueError(f"BGZF index does not match {fpath}")
+            block_size = HEADER.unpack(header)[-1] + 1
+            blocks.append(header + f.read(block_size - HEADER.size))
+    data = b"".join(_get_executor().map(_decompress_block, blocks))
+    skip = start - uoffsets[first]
+    if len(data) < skip + length:
+        raise ValueError(f"BGZF index does not match {fpath}")
+    return data[skip:skip+length]
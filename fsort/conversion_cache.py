@@ -0,0 +1,194 @@
+"""
+FSORT: Persistent cache of DICOM->NIFTI conversion output
+"""
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+
+LOG = logging.getLogger(__name__)
+
+# Linux ioctl to clone (reflink) a file on copy-on-write filesystems
+FICLONE = 0x40049409
+
+
+def link_or_copy(src, dest, hardlink=True):
+    """
+    Make dest a copy of src as cheaply as the filesystem allows
+
+    We try a hard link first, then a reflink, then an in-kernel copy, then
+    fall back to a plain copy
+
+    :param hardlink: If False, never hard link dest to src. Use this when dest may
+                     be modified independently of src
+    """
+    if hardlink:
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            pass
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+                fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdest.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                shutil.copystat(src, dest)
+                return
+        except OSError:
+            pass
+    shutil.copy2(src, dest)
+
+
+class ConversionCache:
+    """
+    Persistent cache of dcm2niix output for individual DICOM folders
+
+    Entries are keyed by the series UID and file listing of the DICOM folder,
+    the dcm2niix binary and the conversion arguments. So the same DICOMs converted
+    the same way are only converted once, even by different pipelines writing
+    to different output folders.
+
+    New entries are written to a temporary folder and only moved into place
+    once the conversion has succeeded, so an interrupted conversion never leaves
+    a partial entry behind.
+    """
+
+    def __init__(self, cachedir):
+        """
+        :param cachedir: Cache folder, created if it does not exist
+        """
+        self.cachedir = os.path.abspath(cachedir)
+        self._exec_ids = {}
+        os.makedirs(os.path.join(self.cachedir, "tmp"), exist_ok=True)
+
+    def key(self, scandir, dcm2niix_cmd):
+        """
+        Get the cache key for converting a DICOM folder
+
+        DICOM files are identified by name, size and modification time, so files
+        rewritten in place are converted again
+
+        :param scandir: DICOM folder
+        :param dcm2niix_cmd: dcm2niix executable and arguments, not including output or input folder
+        :return: Key as hex digest string
+        """
+        fingerprint = hashlib.sha256()
+        fingerprint.update(self._exec_id(dcm2niix_cmd[0]).encode("utf-8"))
+        fingerprint.update(" ".join(dcm2niix_cmd[1:]).encode("utf-8"))
+        files = sorted([e for e in os.scandir(scandir) if e.is_file()], key=lambda e: e.name)
+        fingerprint.update(self._series_uid(files).encode("utf-8"))
+        for entry in files:
+            stat = entry.stat()
+            fingerprint.update(f"{entry.name}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode("utf-8"))
+        return fingerprint.hexdigest()
+
+    def get(self, key):
+        """
+        :return: Path to cached conversion output for key, or None if not cached
+        """
+        entrydir = self._entrydir(key)
+        if os.path.isdir(entrydir):
+            return entrydir
+        return None
+
+    def new_entry(self):
+        """
+        :return: Path to an empty temporary folder to convert into before calling commit()
+        """
+        tmpdir = os.path.join(self.cachedir, "tmp", uuid.uuid4().hex)
+        os.makedirs(tmpdir)
+        return tmpdir
+
+    def commit(self, tmpdir, key):
+        """
+        Move a completed conversion into the cache
+
+        :return: Path to cached conversion output for key
+        """
+        entrydir = self._entrydir(key)
+        os.makedirs(os.path.dirname(entrydir), exist_ok=True)
+        try:
+            os.rename(tmpdir, entrydir)
+        except OSError:
+            # Another process has cached the same conversion already
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        return entrydir
+
+    def restore(self, entrydir, outdir):
+        """
+        Copy the files from a cached conversion into an output folder
+
+        Files are never hard linked, as then changes made to them in the output folder
+        would also change the cache entry. Reflinks are used where the filesystem
+        supports them so the copy is still cheap
+
+        :return: Sequence of paths to copied files
+        """
+        fpaths = []
+        for root, _dirs, files in os.walk(entrydir):
+            destdir = os.path.normpath(os.path.join(outdir, os.path.relpath(root, entrydir)))
+            os.makedirs(destdir, exist_ok=True)
+            for fname in sorted(files):
+                fpath = os.path.join(destdir, fname)
+                link_or_copy(os.path.join(root, fname), fpath, hardlink=False)
+                fpaths.append(fpath)
+        return fpaths
+
+    def _entrydir(self, key):
+        return os.path.join(self.cachedir, key[:2], key)
+
+    def _exec_id(self, dcm2niix_exec):
+        """
+        Identify a dcm2niix binary by the digest of its contents
+        """
+        if dcm2niix_exec not in self._exec_ids:
+            fpath = shutil.which(dcm2niix_exec)
+            if fpath is None:
+                LOG.warn(f"Could not find {dcm2niix_exec} - conversion cache will be keyed by name only")
+                self._exec_ids[dcm2niix_exec] = dcm2niix_exec
+            else:
+                digest = hashlib.sha256()
+                with open(fpath, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(chunk)
+                self._exec_ids[dcm2niix_exec] = digest.hexdigest()
+        return self._exec_ids[dcm2niix_exec]
+
+    def _series_uid(self, files):
+        """
+        Get the SeriesInstanceUID from the first DICOM file in a folder
+        """
+        if pydicom is None:
+            return ""
+        for entry in files:
+            try:
+                dcm = pydicom.dcmread(entry.path, stop_before_pixels=True, specific_tags=["SeriesInstanceUID"])
+                return str(dcm.SeriesInstanceUID)
+            except Exception:
+                # May not be a DICOM
+                continue
+        return ""
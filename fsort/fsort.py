@@ -3,23 +3,97 @@ FSORT: Run study-specific FSORT configurations
 """
 
 import datetime
+import hashlib
 import importlib
+import json
 import logging
 import os
+import re
 import shutil
 import subprocess
 import sys
-from pathlib import Path
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
+from . import bgzf
+from .conversion_cache import ConversionCache, link_or_copy
 from .image_file import ImageFile
+from .nifti_index import NiftiIndex
+from .output_writer import OutputWriter
+from .sorter import Sorter
+
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
 
 LOG = logging.getLogger(__name__)
 
+DICOM_TAGS_TO_SCAN = {
+    "InstanceCreationTime": (0x0008, 0x0013),
+    "InversionTimeDelay": (0x2005, 0x1572),
+    "NumberInversionDelays": (0x2005, 0x1571),
+    "HeartRate": (0x0018, 0x1088),
+    "InversionTimeDelay": (0x0018, 0x0082),
+    "DOB": (0x0010, 0x0030),
+}
+DICOM_SPECIFIC_TAGS = ["SeriesNumber"] + list(DICOM_TAGS_TO_SCAN.values())
+
+# dcm2niix reports each file it writes as 'Convert <n> DICOM as <path without extension> (<dims>)'
+CONVERTED_REGEX = re.compile(r"^Convert \d+ DICOM as (.+) \(", re.MULTILINE)
+
+# Suffixes dcm2niix adds to an output file name when a file of that name already exists
+COLLISION_SUFFIXES = "abcdefghijklmnopqrstuvwxyz"
+
 
 def timestamp():
     return str(datetime.datetime.now())
 
 
+def _dicom_value(val):
+    """
+    Convert a DICOM element value to plain Python types so it can be cached as JSON
+    """
+    if isinstance(val, (list, tuple, pydicom.multival.MultiValue)):
+        return [_dicom_value(v) for v in val]
+    elif isinstance(val, int):
+        return int(val)
+    elif isinstance(val, float):
+        return float(val)
+    elif isinstance(val, str):
+        return str(val)
+    return val
+
+
+class CandidateSets:
+    """
+    Candidate file sets for a single vendor
+
+    This behaves like a mapping from candidate set ID to list of files, but
+    sets are only converted and scanned when first requested
+    """
+
+    def __init__(self, vendor, load_set, num_sets):
+        """
+        :param vendor: Vendor name
+        :param load_set: Callable taking a set ID and returning mapping from vendor to files
+        :param num_sets: Number of candidate sets available
+        """
+        self._vendor = vendor
+        self._load_set = load_set
+        self._num_sets = num_sets
+
+    def __contains__(self, set_id):
+        if not isinstance(set_id, int) or set_id < 0 or set_id >= self._num_sets:
+            return False
+        return self._vendor in self._load_set(set_id)
+
+    def __getitem__(self, set_id):
+        if set_id not in self:
+            raise KeyError(set_id)
+        return self._load_set(set_id)[self._vendor]
+
+
 class Fsort:
     """
     Class to run study-specific FSORT configurations
@@ -39,6 +113,15 @@ class Fsort:
         """
         self._options = options
         self._logfile_handler = None
+        self._conversion_cache = None
+        ImageFile.data_cache.max_bytes = options.max_memory
+        ImageFile.write_gzip_index = options.gzip_index
+        if options.compress_threads:
+            bgzf.set_threads(options.compress_threads)
+        Sorter.writer = OutputWriter(max_workers=options.jobs, max_bytes=options.max_memory)
+        if options.dcm2niix_cache:
+            LOG.info(f" - Using DICOM->NIFTI conversion cache in {options.dcm2niix_cache}")
+            self._conversion_cache = ConversionCache(options.dcm2niix_cache)
         if options.config:
             try:
                 LOG.info(f" - Loading configuration from {options.config}")
@@ -83,16 +166,22 @@ class Fsort:
         LOG.info(f" - Output dir: {output}")
 
         nifti_sets = []
+        scratchdir = None
         if dicom_in:
-            LOG.info(
-                f"DICOM->NIFTI conversion: DICOMS in {dicom_in}: start time {timestamp()}"
-            )
             nifti_output = os.path.join(output, "nifti")
             if not niftidirs:
                 niftidirs = []
+            if self._options.scratch_dir:
+                # Named after the output folder so a kept scratch folder can be reused by --skip-dcm2niix
+                scratchdir = os.path.join(
+                    os.path.abspath(self._options.scratch_dir),
+                    "fsort_" + hashlib.sha256(os.path.abspath(output).encode("utf-8")).hexdigest()[:16],
+                )
+                LOG.info(f" - Converting to uncompressed NIFTI in scratch folder {scratchdir}")
 
+            conversions = {}
             for idx, dcm2niix in enumerate(self._options.dcm2niix):
-                niftidir_dcm2niix = os.path.join(nifti_output, f"dcm2niix_{idx}")
+                niftidir_dcm2niix = os.path.join(scratchdir or nifti_output, f"dcm2niix_{idx}")
                 if (
                     self._options.skip_dcm2niix
                     and os.path.exists(niftidir_dcm2niix)
@@ -102,55 +191,146 @@ class Fsort:
                         f" - NIFTI files already found in {niftidir_dcm2niix} - skipping dcm2niix conversion"
                     )
                 else:
-                    LOG.info(
-                        f" - Converting to nifti using {dcm2niix} output in {niftidir_dcm2niix}"
-                    )
-                    self._dcm2niix(
-                        dicom_in,
-                        niftidir_dcm2niix,
-                        dcm2niix,
-                        self._options.dcm2niix_args,
-                    )
+                    conversions[idx] = (niftidir_dcm2niix, dcm2niix)
 
                 niftidirs_dcm2niix = list(niftidirs) + [niftidir_dcm2niix]
                 nifti_sets.append(niftidirs_dcm2niix)
         elif not niftidirs:
             raise RuntimeError("Must specify DICOM or NIFTI input folder")
         else:
+            conversions = {}
             nifti_sets.append(niftidirs)
 
+        if self._options.dcm2niix_lazy and self._config is not None:
+            # Secondary sets are only converted when a sorter selects them
+            eager_sets = [0]
+        else:
+            eager_sets = list(range(len(nifti_sets)))
+        for niftidir, _dcm2niix in conversions.values():
+            # Check now rather than failing part way through sorting when a set is converted lazily
+            self._check_overwrite(niftidir)
+        index = NiftiIndex(os.path.join(output, "nifti_index.jsonl"))
+        converted = self._convert_nifti_sets(dicom_in, [conversions[idx] for idx in eager_sets if idx in conversions], index)
+        if dicom_in:
+            LOG.info(f"Scanning DICOM tags: start time {timestamp()}")
+            dicom_tags = self._scan_dicom_tags(dicom_in, os.path.join(nifti_output, "dicom_tags.json"))
+        else:
+            dicom_tags = None
+
+        loaded_sets = {}
+        def load_set(idx):
+            if idx not in loaded_sets:
+                if idx not in eager_sets and idx in conversions:
+                    LOG.info(f" - Candidate set {idx} selected for the first time - converting now")
+                    converted.update(self._convert_nifti_sets(dicom_in, [conversions[idx]], index))
+                loaded_sets[idx] = self._load_nifti_set(nifti_sets[idx], dicom_tags, converted, index)
+            return loaded_sets[idx]
+
         vendor_files = {}
-        for idx, niftidirs in enumerate(nifti_sets):
-            LOG.info(f"Scanning NIFTI files in {niftidirs}: start time {timestamp()}")
-            set_vendor_files = self._scan_niftis(
-                niftidirs,
-                allow_no_vendor=self._options.allow_no_vendor,
-                allow_dupes=self._options.allow_dupes,
-            )
-            if not set_vendor_files:
-                LOG.warn("No session files found")
-            else:
-                for vendor, files in set_vendor_files.items():
-                    LOG.info(f" - Vendor: {vendor} ({len(files)} files)")
-                    if dicom_in:
-                        LOG.info(" - Linking DICOM data")
-                        self._link_niftis_to_dicoms(files, dicom_in)
-                    if vendor not in vendor_files:
-                        vendor_files[vendor] = {}
-                    vendor_files[vendor][idx] = files
-
-        if self._config is not None:
-            for sorter in self._config.SORTERS:
-                outdir = os.path.join(output, sorter.name)
-                LOG.info(
-                    f"FSORT RUNNING {sorter.name.upper()} -> {outdir} : start time {timestamp()}"
-                )
-                self._mkdir(outdir)
-                for vendor, file_sets in vendor_files.items():
-                    sorter.process_files(file_sets, vendor, outdir)
-                LOG.info(f"FSORT DONE {sorter.name.upper()} : end time {timestamp()}")
+        for idx in eager_sets:
+            for vendor in load_set(idx):
+                if vendor not in vendor_files:
+                    vendor_files[vendor] = CandidateSets(vendor, load_set, len(nifti_sets))
+
+        try:
+            if self._config is not None:
+                for sorter in self._config.SORTERS:
+                    outdir = os.path.join(output, sorter.name)
+                    LOG.info(
+                        f"FSORT RUNNING {sorter.name.upper()} -> {outdir} : start time {timestamp()}"
+                    )
+                    self._mkdir(outdir)
+                    for vendor, file_sets in vendor_files.items():
+                        sorter.process_files(file_sets, vendor, outdir)
+                    sorter.release_data()
+                    LOG.info(f"FSORT DONE {sorter.name.upper()} : end time {timestamp()}")
+        except BaseException:
+            # Finish writing outputs already queued, but keep the sorter error rather than
+            # replacing it with any write failure
+            try:
+                Sorter.writer.flush()
+            except Exception:
+                LOG.exception("Failed to write output files")
+            raise
+        # Outputs are written in the background so make sure they are all complete
+        LOG.info(f"Waiting for output files to be written: start time {timestamp()}")
+        Sorter.writer.flush()
+        ImageFile.data_cache.clear()
+        if scratchdir is not None and os.path.exists(scratchdir):
+            self._cleanup_scratch(scratchdir, nifti_output)
         LOG.info(f"FSORT DONE -> {output}")
 
+    def _cleanup_scratch(self, scratchdir, nifti_output):
+        """
+        Keep, delete or archive intermediate NIFTI files in the scratch folder
+
+        When archiving, the NIFTI files are compressed into the NIFTI output folder
+        where they would have been written without a scratch folder
+        """
+        if self._options.scratch_cleanup == "keep":
+            LOG.info(f" - Keeping intermediate NIFTI files in {scratchdir}")
+            return
+        if self._options.scratch_cleanup == "archive":
+            LOG.info(f" - Archiving intermediate NIFTI files to {nifti_output}")
+            for root, _dirs, files in os.walk(scratchdir):
+                destdir = os.path.normpath(os.path.join(nifti_output, os.path.relpath(root, scratchdir)))
+                os.makedirs(destdir, exist_ok=True)
+                for fname in files:
+                    fpath = os.path.join(root, fname)
+                    if fname.endswith(".nii"):
+                        with open(fpath, "rb") as fin, bgzf.BgzfWriter(os.path.join(destdir, fname + ".gz")) as fout:
+                            shutil.copyfileobj(fin, fout, bgzf.BLOCK_SIZE * 16)
+                    else:
+                        link_or_copy(fpath, os.path.join(destdir, fname))
+        LOG.info(f" - Removing scratch folder {scratchdir}")
+        shutil.rmtree(scratchdir, ignore_errors=True)
+
+    def _convert_nifti_sets(self, dicom_in, conversions, index):
+        """
+        Convert DICOMs for one or more candidate sets
+
+        :param conversions: Sequence of (output dir, dcm2niix executable)
+        :param index: NiftiIndex to use when loading converted files
+        :return: Mapping from output dir to sequence of converted ImageFile instances
+        """
+        if not conversions:
+            return {}
+        LOG.info(
+            f"DICOM->NIFTI conversion: DICOMS in {dicom_in}: start time {timestamp()}"
+        )
+        for niftidir, dcm2niix in conversions:
+            LOG.info(
+                f" - Converting to nifti using {dcm2niix} output in {niftidir}"
+            )
+        return self._dcm2niix(dicom_in, conversions, self._options.dcm2niix_args, index)
+
+    def _load_nifti_set(self, niftidirs, dicom_tags, converted, index):
+        """
+        Scan the NIFTI files for a single candidate set
+
+        :param dicom_tags: Table of DICOM tag values to link to NIFTI files, or None if no DICOM input
+
+        :param converted: Mapping from NIFTI dir to ImageFile instances already loaded during conversion
+        :param index: NiftiIndex to take unchanged file metadata from. Updated with scanned files
+        :return: Mapping from vendor name to list of ImageFile instances
+        """
+        LOG.info(f"Scanning NIFTI files in {niftidirs}: start time {timestamp()}")
+        vendor_files = self._scan_niftis(
+            niftidirs,
+            allow_no_vendor=self._options.allow_no_vendor,
+            allow_dupes=self._options.allow_dupes,
+            converted=converted,
+            index=index,
+        )
+        if not vendor_files:
+            LOG.warn("No session files found")
+        for vendor, files in vendor_files.items():
+            LOG.info(f" - Vendor: {vendor} ({len(files)} files)")
+            if dicom_tags is not None:
+                LOG.info(" - Linking DICOM data")
+                self._link_niftis_to_dicoms(files, dicom_tags)
+        return vendor_files
+
     def _start_logfile(self, output_folder):
         """
         Set up a logfile to capture logging output in the output folder
@@ -169,97 +349,291 @@ class Fsort:
         )
         logging.getLogger().addHandler(self._logfile_handler)
 
+    def _check_overwrite(self, dirname):
+        """
+        Check an output directory can be created, i.e. does not exist unless we can overwrite it
+        """
+        if os.path.exists(dirname) and not self._options.overwrite:
+            raise RuntimeError(
+                f"Output directory {dirname} already exists - use --overwrite to remove"
+            )
+
     def _mkdir(self, dirname, wipe=True):
         """
         Create an output directory, checking if it exists and whether we can overwrite it
         """
         if os.path.exists(dirname):
-            if not self._options.overwrite:
-                raise RuntimeError(
-                    f"Output directory {dirname} already exists - use --overwrite to remove"
-                )
-            elif wipe:
+            self._check_overwrite(dirname)
+            if wipe:
                 shutil.rmtree(dirname)
             else:
                 return
 
         os.makedirs(dirname, mode=0o777)
 
-    def _dcm2niix(self, dicomdir, niftidir, dcm2niix_exec, args):
+    def _dcm2niix(self, dicomdir, conversions, args, index=None):
         """
         Run DCM2NIIX if we are using DICOM input
 
-        We walk the dicomdir tree and run dcm2niix on every folder that contains files
+        We walk the dicomdir tree and run dcm2niix on every folder that contains files.
+        Each folder is converted into its own temporary folder so that folders can be
+        converted in parallel (up to options.jobs at a time) without their outputs
+        interfering with each other. The files are then moved into the output dir in
+        walk order, naming them as if dcm2niix had converted each folder straight into
+        it in turn.
+
+        When there are multiple dcm2niix executables, each folder is converted by all of
+        them together so the DICOMs are only read from disk once.
+
+        As soon as a folder's files have been moved into place, they are handed to a pool
+        of scanning workers, so by the time conversion finishes most of the files have
+        already been loaded
+
+        :param conversions: Sequence of (output dir, dcm2niix executable)
+        :param index: Optional NiftiIndex to use when loading converted files
+        :return: Mapping from output dir to sequence of converted ImageFile instances
         """
-        self._mkdir(niftidir)
+        for niftidir, _dcm2niix_exec in conversions:
+            self._mkdir(niftidir)
         args = args.split()
-        dcm2niix_cmd = (
-            [dcm2niix_exec, "-o", niftidir] + args + ["-d", "0", "-z", "y", "-b", "y"]
-        )
+        # Intermediate files in a scratch folder are left uncompressed so they can be memory mapped
+        compress = "n" if self._options.scratch_dir else "y"
+        scandirs, num_files = self._find_dicom_dirs(dicomdir)
+        converted = {niftidir: [] for niftidir, _dcm2niix_exec in conversions}
+        tmpdirs = {niftidir: tempfile.mkdtemp(prefix=".fsort_tmp_", dir=niftidir) for niftidir, _dcm2niix_exec in conversions}
+        try:
+            with ThreadPoolExecutor(max_workers=self._options.jobs) as scan_executor, \
+                 ThreadPoolExecutor(max_workers=self._options.jobs * len(conversions)) as executor:
+                jobs = []
+                for idx, scandir in enumerate(scandirs):
+                    for niftidir, dcm2niix_exec in conversions:
+                        dcm2niix_cmd = [dcm2niix_exec] + args + ["-d", "0", "-z", compress, "-b", "y"]
+                        outdir = os.path.join(tmpdirs[niftidir], str(idx))
+                        job = executor.submit(self._dcm2niix_dir, dcm2niix_cmd, scandir, outdir)
+                        jobs.append((niftidir, dcm2niix_exec, scandir, outdir, job))
+
+                # Move files and report results in walk order so output names and logs are
+                # independent of scheduling
+                for niftidir, dcm2niix_exec, scandir, outdir, job in jobs:
+                    LOG.debug(f" - Converted DICOMS in {scandir} using {dcm2niix_exec}")
+                    try:
+                        output, fpaths = job.result()
+                        LOG.debug(output)
+                        fpaths = self._move_converted(outdir, niftidir, fpaths)
+                        converted[niftidir].extend(
+                            scan_executor.submit(self._load_nifti, fpath, index) for fpath in fpaths
+                        )
+                    except subprocess.CalledProcessError as exc:
+                        LOG.warn(
+                            f"{dcm2niix_exec} failed for {scandir} with exit code {exc.returncode}"
+                        )
+                        LOG.warn(exc.output)
+        finally:
+            for tmpdir in tmpdirs.values():
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+        for niftidir, _dcm2niix_exec in conversions:
+            with open(os.path.join(niftidir, "num_dicoms.txt"), "w") as f:
+                f.write("%i\n" % num_files)
+
+        return {
+            niftidir: [scan_job.result() for scan_job in scan_jobs]
+            for niftidir, scan_jobs in converted.items()
+        }
+
+    def _find_dicom_dirs(self, dicomdir):
+        """
+        Find folders containing files in a DICOM tree
+
+        :return: Tuple of list of folders in walk order, total number of files found
+        """
         scandirs = []
         num_files = 0
         for root, _dirs, files in os.walk(dicomdir, topdown=False, followlinks=True):
             num_files += len(files)
             if files:
-                scandir = Path(os.path.join(dicomdir, root))
-                for scandir_done in scandirs:
-                    if scandir_done in scandir.parents:
-                        continue
-                cmd = dcm2niix_cmd + [str(scandir)]
-                LOG.debug(f" - Converting DICOMS in {scandir}")
-                LOG.debug(" ".join(cmd))
+                scandirs.append(root)
+        return scandirs, num_files
+
+    def _dcm2niix_dir(self, dcm2niix_cmd, scandir, outdir):
+        """
+        Convert a single folder of DICOMs
+
+        If a conversion cache is in use, we only run dcm2niix if the cache does not
+        already have output for the same DICOMs, executable and arguments
+
+        :param outdir: Output folder for this conversion only
+        :return: Tuple of dcm2niix output, sequence of converted NIFTI file paths
+        """
+        os.makedirs(outdir, exist_ok=True)
+        if self._conversion_cache is None:
+            output = self._run_dcm2niix(dcm2niix_cmd, scandir, outdir)
+        else:
+            key = self._conversion_cache.key(scandir, dcm2niix_cmd)
+            entrydir = self._conversion_cache.get(key)
+            if entrydir is not None:
+                output = f"Using cached conversion {entrydir}"
+            else:
+                tmpdir = self._conversion_cache.new_entry()
                 try:
-                    output = subprocess.check_output(cmd)
-                    LOG.debug(output)
-                except subprocess.CalledProcessError as exc:
-                    LOG.warn(
-                        f"{dcm2niix_exec} failed for {scandir} with exit code {exc.returncode}"
-                    )
-                    LOG.warn(exc.output)
+                    output = self._run_dcm2niix(dcm2niix_cmd, scandir, tmpdir)
+                except:
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+                    raise
+                entrydir = self._conversion_cache.commit(tmpdir, key)
+            self._conversion_cache.restore(entrydir, outdir)
+
+        return output, self._converted_niftis(output, outdir)
+
+    def _run_dcm2niix(self, dcm2niix_cmd, scandir, outdir):
+        cmd = dcm2niix_cmd[:1] + ["-o", outdir] + dcm2niix_cmd[1:] + [scandir]
+        LOG.debug(" ".join(cmd))
+        return subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+
+    def _converted_niftis(self, output, outdir):
+        """
+        Identify the NIFTI files created by a dcm2niix run
 
-        with open(os.path.join(niftidir, "num_dicoms.txt"), "w") as f:
-            f.write("%i\n" % num_files)
+        Files are listed in the order dcm2niix reports writing them, followed by
+        any others found in the output folder. This picks up outputs dcm2niix does
+        not report, e.g. tilt corrected or equalized images, and everything restored
+        from the conversion cache
+
+        :return: Sequence of NIFTI file paths
+        """
+        if isinstance(output, bytes):
+            output = output.decode("utf-8", errors="replace")
+        fpaths, found = [], set()
+        for match in CONVERTED_REGEX.finditer(output):
+            # Reported paths include the output folder, as given to dcm2niix, and any subfolders from -f
+            fpath_noext = os.path.join(outdir, os.path.relpath(os.path.abspath(match.group(1)), os.path.abspath(outdir)))
+            for ext in (".nii.gz", ".nii"):
+                fpath = os.path.normpath(fpath_noext + ext)
+                if fpath not in found and os.path.exists(fpath):
+                    fpaths.append(fpath)
+                    found.add(fpath)
+                    break
+        for path, dirs, files in os.walk(outdir, followlinks=True):
+            dirs.sort()
+            for fname in sorted(files):
+                fpath = os.path.normpath(os.path.join(path, fname))
+                if (fname.endswith(".nii") or fname.endswith(".nii.gz")) and fpath not in found:
+                    fpaths.append(fpath)
+                    found.add(fpath)
+        return fpaths
+
+    def _move_converted(self, outdir, niftidir, fpaths):
+        """
+        Move the files from a single dcm2niix run into the shared output folder
+
+        Files keep their path relative to the run's output folder. If a file of the same
+        name is already there from an earlier run, a letter is added to the name of the
+        file and its sidecars, as dcm2niix does when converting into a folder which
+        already contains the file. Names which dcm2niix has already given a letter
+        within the run are taken back to their base name first, so they get the
+        next free letters in the shared folder as well
+
+        :param outdir: Output folder for the run
+        :param fpaths: NIFTI files from the run
+        :return: New paths of the NIFTI files
+        """
+        moved = {}
+        for root, dirs, files in os.walk(outdir):
+            dirs.sort()
+            destdir = os.path.normpath(os.path.join(niftidir, os.path.relpath(root, outdir)))
+            os.makedirs(destdir, exist_ok=True)
+            stems = {}
+            for fname in sorted(files):
+                stem, ext = fname[:-7], fname[-7:]
+                if ext != ".nii.gz":
+                    stem, ext = os.path.splitext(fname)
+                stems.setdefault(stem, []).append(ext)
+            # Base name first, then the names dcm2niix added letters to in order
+            bases = {
+                stem: stem[:-1] if stem[-1:] in COLLISION_SUFFIXES and stem[:-1] in stems else stem
+                for stem in stems
+            }
+            for stem in sorted(stems, key=lambda stem: (bases[stem], stem != bases[stem], stem)):
+                base, exts = bases[stem], stems[stem]
+                for suffix in [""] + list(COLLISION_SUFFIXES):
+                    if not any(os.path.lexists(os.path.join(destdir, base + suffix + ext)) for ext in exts):
+                        break
+                else:
+                    raise RuntimeError(f"Too many files named {base} in {destdir}")
+                for ext in exts:
+                    src = os.path.normpath(os.path.join(root, stem + ext))
+                    moved[src] = os.path.join(destdir, base + suffix + ext)
+                    os.replace(src, moved[src])
+        return [moved[fpath] for fpath in fpaths if fpath in moved]
+
+    def _load_nifti(self, fpath, index=None):
+        """
+        :param index: Optional NiftiIndex to take metadata from if the file is unchanged
+        :return: ImageFile instance for fpath, or None if it could not be loaded
+        """
+        try:
+            return ImageFile(fpath, warn_json=True, index=index)
+        except Exception:
+            LOG.exception(
+                f"Failed to load NIFTI file {fpath} - ignoring"
+            )
+            return None
 
-    def _scan_niftis(self, niftidirs, allow_no_vendor=False, allow_dupes=False):
+    def _scan_niftis(self, niftidirs, allow_no_vendor=False, allow_dupes=False, converted=None, index=None):
         """
         Scan NIFTI files extracting metadata in useful format for matching
 
         :param niftidir: Path to folder containing Nifti files (not necessarily flat)
         :param allow_no_vendor: If True, keep files with no vendor in metadata
         :param allow_dupes: If True, keep files where the image content exactly matches another file
+        :param converted: Optional mapping from NIFTI dir to ImageFile instances already loaded. These dirs will not be scanned again
+        :param index: Optional NiftiIndex. Files which have not changed since they were indexed are not read,
+                      and the index is updated with the results of the scan
         :return: Mapping from vendor name to list of ImageFile instances
         """
-        vendor_files = {}
-        for niftidir in niftidirs:
-            for path, _dirs, files in os.walk(niftidir, followlinks=True):
-                for fname in files:
-                    if fname.endswith(".nii") or fname.endswith(".nii.gz"):
-                        try:
-                            fpath = os.path.join(path, fname)
-                            file = ImageFile(fpath, warn_json=True)
-                        except Exception:
-                            LOG.exception(
-                                f"Failed to load NIFTI file {fpath} - ignoring"
-                            )
-                            continue
-
-                        LOG.debug(
-                            f" - Found candidate file {fpath} for vendor {file.vendor}"
-                        )
-                        if file.vendor not in vendor_files:
-                            vendor_files[file.vendor] = []
-                        if not allow_dupes:
-                            dupes = [
-                                f
-                                for f in vendor_files[file.vendor]
-                                if f.hash == file.hash
-                            ]
-                            if dupes:
-                                LOG.warn(
-                                    f"{fpath} is exact duplicate of existing file {dupes[0].fname} - ignoring"
-                                )
-                                continue
-                        vendor_files[file.vendor].append(file)
+        if converted is None:
+            converted = {}
+        candidates = []
+        with ThreadPoolExecutor(max_workers=self._options.jobs) as executor:
+            for niftidir in niftidirs:
+                if niftidir in converted:
+                    files = [f for f in converted[niftidir] if f is not None]
+                    candidates.extend(sorted(files, key=lambda f: f.fpath))
+                    continue
+                fpaths = []
+                for path, dirs, files in os.walk(niftidir, followlinks=True):
+                    dirs.sort()
+                    for fname in sorted(files):
+                        if fname.endswith(".nii") or fname.endswith(".nii.gz"):
+                            fpaths.append(os.path.join(path, fname))
+                # Files are loaded in parallel but results are kept in path order
+                # so duplicate handling does not depend on scheduling
+                candidates.extend(executor.map(self._load_nifti, fpaths, [index] * len(fpaths)))
+
+        vendor_files, vendor_dupe_index = {}, {}
+        for file in candidates:
+            if file is None:
+                continue
+            LOG.debug(
+                f" - Found candidate file {file.fpath} for vendor {file.vendor}"
+            )
+            if file.vendor not in vendor_files:
+                vendor_files[file.vendor] = []
+                vendor_dupe_index[file.vendor] = {}
+            if not allow_dupes:
+                dupe = self._find_dupe(file, vendor_dupe_index[file.vendor])
+                if dupe is not None:
+                    LOG.warn(
+                        f"{file.fpath} is exact duplicate of existing file {dupe.fname} - ignoring"
+                    )
+                    continue
+            vendor_files[file.vendor].append(file)
+
+        if index is not None:
+            # Save now, while metadata is as read from the files, and hashes found for duplicate
+            # detection can be included
+            index.update([f for f in candidates if f is not None])
+            index.save()
 
         no_vendor_files = vendor_files.pop(None, [])
         if allow_no_vendor and no_vendor_files:
@@ -272,36 +646,80 @@ class Fsort:
 
         return vendor_files
 
-    def _link_niftis_to_dicoms(self, nifti_files, dicomdir):
-        tags_to_scan = {
-            "InstanceCreationTime": (0x0008, 0x0013),
-            "InversionTimeDelay": (0x2005, 0x1572),
-            "NumberInversionDelays": (0x2005, 0x1571),
-            "HeartRate": (0x0018, 0x1088),
-            "InversionTimeDelay": (0x0018, 0x0082),
-            "DOB": (0x0010, 0x0030),
-        }
+    def _find_dupe(self, file, dupe_index):
+        """
+        Find a previously seen file whose content exactly matches a file
 
-        dicom_tag_dict = {}
+        Files can only be identical if their size and header geometry match, so
+        we only compute content hashes for files where this happens. Most files are
+        therefore never hashed at all
+
+        :param dupe_index: Mapping from (size, shape, dtype, affine) to mapping from hash to
+                           ImageFile. Updated with file if it is not a duplicate
+        :return: Existing ImageFile with the same content, or None
+        """
+        key = (file.filesize, file.shape, file.dtype.str, file.affinedata)
+        files = dupe_index.setdefault(key, {})
+        if not files:
+            # Defer hashing until there is something to compare with
+            files[None] = file
+            return None
+        if None in files:
+            existing = files.pop(None)
+            files[existing.hash] = existing
+        dupe = files.get(file.hash, None)
+        if dupe is None:
+            files[file.hash] = file
+        return dupe
+
+    def _scan_dicom_tags(self, dicomdir, cache_fpath):
+        """
+        Build a table of DICOM tag values for each series
+
+        This only needs doing once per session as it is the same for every candidate set
+        and vendor. The table is saved to cache_fpath with a fingerprint of the DICOM file
+        listing and the tags scanned, and reused as long as neither has changed
+
+        :return: Mapping from series number to sequence of per-file dictionaries of tag values,
+                 ordered by instance creation time
+        """
+        if pydicom is None:
+            LOG.warn("pydicom not available - cannot link DICOM metadata to NIFTI files")
+            return {}
+
+        fpaths = []
+        fingerprint = hashlib.sha256()
+        # The table must be rebuilt if the tags we scan for change
+        fingerprint.update(f"{sorted(DICOM_TAGS_TO_SCAN.items())}\n".encode("utf-8"))
         for root, _dirs, files in os.walk(dicomdir, topdown=False, followlinks=True):
             for fname in files:
                 fpath = os.path.join(root, fname)
+                fpaths.append(fpath)
                 try:
-                    import pydicom
+                    stat = os.stat(fpath)
+                    fingerprint.update(f"{os.path.relpath(fpath, dicomdir)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode("utf-8"))
+                except OSError:
+                    pass
+        fingerprint = fingerprint.hexdigest()
+
+        if os.path.exists(cache_fpath):
+            try:
+                with open(cache_fpath, "r") as f:
+                    cached = json.load(f)
+                if cached["fingerprint"] == fingerprint:
+                    LOG.info(f" - Using DICOM tags from {cache_fpath}")
+                    return {series_number: metadata for series_number, metadata in cached["series"]}
+            except Exception:
+                LOG.warn(f"Failed to read DICOM tags from {cache_fpath} - rescanning")
 
-                    dcm = pydicom.dcmread(fpath)
-                    series_number = dcm["SeriesNumber"].value
+        dicom_tag_dict = {}
+        with ThreadPoolExecutor(max_workers=self._options.jobs) as executor:
+            for tags in executor.map(self._read_dicom_tags, fpaths):
+                if tags is not None:
+                    series_number, dcm_metadata = tags
                     if series_number not in dicom_tag_dict:
                         dicom_tag_dict[series_number] = []
-                    dcm_metadata = {}
-                    for name, tag in tags_to_scan.items():
-                        md = dcm.get(tag, None)
-                        if md and md.value is not None:
-                            dcm_metadata[name] = md.value
                     dicom_tag_dict[series_number].append(dcm_metadata)
-                except Exception:
-                    # May not be a DICOM
-                    pass
 
         def _to_float(val):
             try:
@@ -312,8 +730,46 @@ class Fsort:
         for series_number, metadata in dicom_tag_dict.items():
             metadata.sort(key=lambda x: _to_float(x.get("InstanceCreationTime", x.get("AcquisitionTime", 0))))
 
+        try:
+            os.makedirs(os.path.dirname(cache_fpath), exist_ok=True)
+            with open(cache_fpath, "w") as f:
+                json.dump({"fingerprint": fingerprint, "series": list(dicom_tag_dict.items())}, f)
+        except (OSError, TypeError):
+            LOG.warn(f"Failed to save DICOM tags to {cache_fpath}")
+            if os.path.exists(cache_fpath):
+                os.remove(cache_fpath)
+        return dicom_tag_dict
+
+    def _read_dicom_tags(self, fpath):
+        """
+        Read the tags we need from a single DICOM file
+
+        Only the header tags we need are parsed - never the pixel data
+
+        :return: Tuple of series number, dictionary of tag values. None if not a DICOM file
+        """
+        try:
+            # Files without a DICOM preamble fail here after reading only a few bytes
+            dcm = pydicom.dcmread(fpath, stop_before_pixels=True, specific_tags=DICOM_SPECIFIC_TAGS)
+            series_number = _dicom_value(dcm["SeriesNumber"].value)
+            dcm_metadata = {}
+            for name, tag in DICOM_TAGS_TO_SCAN.items():
+                md = dcm.get(tag, None)
+                if md and md.value is not None:
+                    dcm_metadata[name] = _dicom_value(md.value)
+            return series_number, dcm_metadata
+        except Exception:
+            # May not be a DICOM
+            return None
+
+    def _link_niftis_to_dicoms(self, nifti_files, dicom_tag_dict):
+        """
+        Add DICOM tag values to NIFTI file metadata
+
+        :param dicom_tag_dict: Table of DICOM tag values as returned by _scan_dicom_tags
+        """
         for img in nifti_files:
             if img.seriesnumber in dicom_tag_dict:
                 dcm_metadata = dicom_tag_dict[img.seriesnumber]
-                for name in tags_to_scan:
+                for name in DICOM_TAGS_TO_SCAN:
                     img.metadata[name] = [v[name] for v in dcm_metadata if name in v]
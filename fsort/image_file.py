@@ -1,22 +1,386 @@
 """
 FSORT: Class representing a image file
 """
+import base64
+import collections
+import functools
 import hashlib
 import json
 import logging
-import math
 import os
 import re
+import threading
+import zlib
 
 import numpy as np
 import nibabel as nib
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import apply_read_scaling
+
+from . import bgzf
+from .conversion_cache import link_or_copy
 
 LOG = logging.getLogger(__name__)
 FLOAT_TOL = 1e-3
+HASH_CHUNK_SIZE = 1024 * 1024
 
 def _norm(s):
     return s.lower().replace(" ", "_").replace("-", "_")
 
+def _format_mdval(val, keep_case, replace_spaces):
+    if isinstance(val, str) and not keep_case:
+        val = val.lower()
+    if isinstance(val, str) and replace_spaces:
+        val = val.replace(" ", "_")
+    if isinstance(val, list) and len(val) > 0 and isinstance(val[0], str) and not keep_case:
+        val = [v.lower() for v in val]
+    if isinstance(val, list) and len(val) > 0 and isinstance(val[0], str) and replace_spaces:
+        val = [v.replace(" ", "_") for v in val]
+    return val
+
+_MISSING = object()
+
+class _Criterion:
+    """
+    Single key/value matching criterion, compiled for testing against many files
+
+    The query value is normalized, and the comparison chosen as far as possible,
+    once here rather than for every file tested
+    """
+
+    def __init__(self, key, value, match_type):
+        self.key = key
+        self.value = value
+        self.match_type = match_type
+        self._exact = match_type == "exact"
+        self._strings = match_type in ("contains", "exact") and (
+            isinstance(value, str) or (isinstance(value, list) and all(isinstance(v, str) for v in value))
+        )
+        if self._strings:
+            self._norm_values = [_norm(v) for v in ([value] if isinstance(value, str) else value)]
+
+    def __call__(self, myval):
+        """
+        :param myval: Value of the attribute for the file being tested
+        :return: True if myval matches the criterion
+        """
+        value = self.value
+        if value is None or myval is None:
+            return value is None and myval is None
+        if isinstance(myval, float) and isinstance(value, float):
+            return abs(value - myval) < FLOAT_TOL
+        if isinstance(myval, int) and isinstance(value, int):
+            return value == myval
+        if isinstance(myval, (list, tuple)) and isinstance(value, (list, tuple)):
+            return np.allclose(list(value), list(myval))
+        if self._strings and isinstance(myval, str):
+            myval = _norm(myval)
+            if self._exact:
+                return myval in self._norm_values
+            return any(v in myval for v in self._norm_values)
+        if self._strings and isinstance(myval, list):
+            # Only reached for a single query string
+            return self._norm_values[0] in [_norm(v) for v in myval]
+        if self.match_type == "len" and isinstance(value, int):
+            return len(myval) == value
+        raise NotImplementedError(f"Don't know how to test type {type(myval)} {self.match_type} {type(value)}")
+
+def _freeze(value):
+    """
+    :return: Hashable form of a query value which keeps the types of value and its items
+    """
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_freeze(v) for v in value))
+    return (type(value), value)
+
+def _thaw(frozen):
+    """
+    :return: New copy of the query value a frozen form was made from
+    """
+    value_type, value = frozen
+    if value_type in (list, tuple):
+        return value_type(_thaw(v) for v in value)
+    return value
+
+@functools.lru_cache(maxsize=1024)
+def _compile_frozen_criteria(match_type, frozen_kwargs):
+    return tuple(_Criterion(k, _thaw(v), match_type) for k, v in frozen_kwargs)
+
+def _compile_criteria(match_type, kwargs):
+    """
+    :return: Sequence of compiled criteria for matching keyword arguments, cached by their values
+    """
+    try:
+        frozen_kwargs = tuple((k, _freeze(v)) for k, v in kwargs.items())
+        return _compile_frozen_criteria(match_type, frozen_kwargs)
+    except TypeError:
+        # Unhashable query value - compile without caching
+        return [_Criterion(k, v, match_type) for k, v in kwargs.items()]
+
+def match_files(files, match_type="contains", **kwargs):
+    """
+    Find the files which match some specification, as for ImageFile.matches
+
+    Each criterion is tested against all remaining files in turn
+
+    :param files: Sequence of ImageFile instances
+    :return: List of matching files, in their original order
+    """
+    files = list(files)
+    for criterion in _compile_criteria(match_type, kwargs):
+        key = criterion.key
+        files = [f for f in files if criterion(getattr(f, key, None))]
+        if not files:
+            break
+    return files
+
+def _save_nifti(nii, fname, index=False):
+    """
+    Save a nibabel image, writing compressed files as BGZF so they are compressed in parallel
+
+    :param index: If True, also write a block offset index sidecar for compressed files
+    :return: Number of bytes written, before compression
+    """
+    _remove_index(fname)
+    if fname.endswith(".gz"):
+        with bgzf.BgzfWriter(fname, index=index) as f:
+            nii.to_file_map(nii.make_file_map({"image": f, "header": f}))
+            return f.tell()
+    nii.to_filename(fname)
+    return os.path.getsize(fname)
+
+def _check_size(fname, nbytes, header):
+    """
+    Check the number of bytes written to an image file matches its header
+    """
+    # nibabel moves the data past the header and extensions if the offset is not already set
+    offset = max(int(header.get_data_offset()), header.single_vox_offset + header.extensions.get_sizeondisk())
+    expected = offset + int(np.prod(header.get_data_shape())) * header.get_data_dtype().itemsize
+    if nbytes != expected:
+        raise RuntimeError(f"Wrote {nbytes} bytes of image data to {fname} - expected {expected}")
+
+def _write_sidecars(sidecars):
+    for fpath, content in sidecars:
+        if isinstance(content, str):
+            with open(fpath, 'w') as fp:
+                fp.write(content)
+        else:
+            np.savetxt(fpath, content)
+
+def _saved_metadata(sidecars):
+    """
+    :return: Metadata an ImageFile would load from the sidecars written by _write_sidecars
+    """
+    metadata = {}
+    for fpath, content in sidecars:
+        if isinstance(content, str):
+            metadata.update(json.loads(content))
+        elif fpath.endswith(".bval"):
+            metadata["bval"] = np.atleast_1d(np.asarray(content, dtype=float))
+        else:
+            metadata["bvec"] = np.atleast_1d(np.asarray(content, dtype=float))
+    return metadata
+
+def _write_derived(nii, fname, sidecars):
+    nbytes = _save_nifti(nii, fname, index=ImageFile.write_gzip_index)
+    _check_size(fname, nbytes, nii.header)
+    _write_sidecars(sidecars)
+    return ImageFile(fname, header=nii.header, metadata=_saved_metadata(sidecars))
+
+def _write_streamed(header, chunks, fname, sidecars):
+    _remove_index(fname)
+    if fname.endswith(".gz"):
+        f = bgzf.BgzfWriter(fname, index=ImageFile.write_gzip_index)
+    else:
+        f = open(fname, "wb")
+    with f:
+        header.write_to(f)
+        f.write(b"\x00" * (int(header.get_data_offset()) - f.tell()))
+        for chunk in chunks:
+            f.write(np.asarray(chunk, dtype=header.get_data_dtype()).tobytes(order="F"))
+        _check_size(fname, f.tell(), header)
+    _write_sidecars(sidecars)
+    return ImageFile(fname, header=header, metadata=_saved_metadata(sidecars))
+
+def _write_copy(src, fname, sidecars):
+    if os.path.lexists(fname):
+        # Do not write through an existing link to a source file
+        os.remove(fname)
+    _remove_index(fname)
+    link_or_copy(src, fname, hardlink=False)
+    if os.path.getsize(fname) != os.path.getsize(src):
+        raise RuntimeError(f"Copy of {src} to {fname} is incomplete")
+    if ImageFile.write_gzip_index and fname.endswith(".gz"):
+        if os.path.exists(src + bgzf.INDEX_EXT):
+            link_or_copy(src + bgzf.INDEX_EXT, fname + bgzf.INDEX_EXT, hardlink=False)
+        else:
+            bgzf.write_index(fname + bgzf.INDEX_EXT, bgzf.build_index(src))
+    _write_sidecars(sidecars)
+
+def _remove_index(fname):
+    # An index left over from a previous file of the same name would not match
+    if os.path.exists(fname + bgzf.INDEX_EXT):
+        os.remove(fname + bgzf.INDEX_EXT)
+
+class _Metadata(dict):
+    """
+    Metadata dictionary supporting fast case-insensitive lookup
+
+    An index from normalized key to actual key is built on first lookup and
+    formatted values are cached per key. Both are discarded whenever the
+    dictionary is modified
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._invalidate()
+
+    def _invalidate(self):
+        self._norm_keys = None
+        self._values = {}
+
+    def lookup(self, key, keep_case=False, replace_spaces=True):
+        """
+        :return: Formatted value for case-insensitive key, or _MISSING if not found
+        """
+        cache_key = (key, keep_case, replace_spaces)
+        if cache_key not in self._values:
+            if self._norm_keys is None:
+                # Later keys take precedence if more than one normalizes the same way
+                self._norm_keys = {_norm(k): k for k in self}
+            actual_key = self._norm_keys.get(_norm(key), _MISSING)
+            if actual_key is _MISSING:
+                self._values[cache_key] = _MISSING
+            else:
+                self._values[cache_key] = _format_mdval(self[actual_key], keep_case, replace_spaces)
+        return self._values[cache_key]
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._invalidate()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._invalidate()
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._invalidate()
+
+    def __ior__(self, other):
+        dict.update(self, other)
+        self._invalidate()
+        return self
+
+    def setdefault(self, key, default=None):
+        self._invalidate()
+        return dict.setdefault(self, key, default)
+
+    def pop(self, *args):
+        self._invalidate()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._invalidate()
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self._invalidate()
+
+class DataCache:
+    """
+    Memory-bounded cache of decoded image data shared by all ImageFile instances
+
+    Arrays are evicted least-recently-used first once the total size exceeds
+    max_bytes. Arrays for images which are pinned, i.e. still needed by a sorter
+    that is running, are only evicted if nothing else can be. Data for unpinned
+    images stays cached so later sorters can use it without decoding the file
+    again. Callers can also release arrays explicitly
+    """
+
+    def __init__(self, max_bytes=None):
+        """
+        :param max_bytes: Memory budget in bytes. If None, the cache is unbounded
+        """
+        self.max_bytes = max_bytes
+        self._arrays = collections.OrderedDict()
+        self._pins = collections.Counter()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, img, raw=False):
+        """
+        :param raw: If True, get the array of raw stored values rather than the scaled data
+        :return: Cached data array for ImageFile img, or None if not cached
+        """
+        with self._lock:
+            data = self._arrays.get((id(img), raw), (None, None))[1]
+            if data is not None:
+                self._arrays.move_to_end((id(img), raw))
+            return data
+
+    def put(self, img, data, raw=False):
+        """
+        Add the data array for ImageFile img, evicting older arrays if over budget
+        """
+        with self._lock:
+            self._remove((id(img), raw))
+            self._arrays[(id(img), raw)] = (img, data)
+            self._nbytes += data.nbytes
+            self._evict()
+
+    def pin(self, imgs):
+        """
+        Mark a sequence of ImageFile instances as needed by one more user
+        """
+        with self._lock:
+            self._pins.update(id(img) for img in imgs)
+
+    def unpin(self, imgs):
+        """
+        Mark a sequence of ImageFile instances as needed by one less user
+
+        Their data stays cached, but is evicted in preference to pinned data
+        """
+        with self._lock:
+            self._pins.subtract(id(img) for img in imgs)
+            self._pins = +self._pins
+            self._evict()
+
+    def release(self, imgs):
+        """
+        Release cached data arrays for a sequence of ImageFile instances
+        """
+        with self._lock:
+            for img in imgs:
+                self._remove((id(img), False))
+                self._remove((id(img), True))
+
+    def clear(self):
+        with self._lock:
+            self._arrays.clear()
+            self._pins.clear()
+            self._nbytes = 0
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        # Unpinned arrays first, then pinned, always keeping the most recent
+        for pinned in (False, True):
+            for key in list(self._arrays)[:-1]:
+                if self._nbytes <= self.max_bytes:
+                    return
+                img = self._arrays[key][0]
+                if (self._pins[id(img)] > 0) == pinned:
+                    LOG.debug(f" - Evicting data for {img.fname} from memory")
+                    self._remove(key)
+
+    def _remove(self, key):
+        entry = self._arrays.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry[1].nbytes
+
 class ImageFile:
     """
     FSORT: An image file and associated metadata
@@ -26,10 +390,21 @@ class ImageFile:
     e.g substring or list contents, case sensitive or not.
     """
 
-    def __init__(self, fpath, warn_json=False):
+    # Decoded data arrays for all images. The memory budget is set by Fsort
+    data_cache = DataCache()
+
+    # If True, compressed output files get a BGZF block offset index sidecar. Set by Fsort
+    write_gzip_index = False
+
+    def __init__(self, fpath, warn_json=False, index=None, header=None, metadata=None):
         """
         :param fpath: Path to the NIFTI image file
         :warn_json: If True, warn if no JSON sidecar can be found
+        :param index: Optional NiftiIndex. If it has an up to date entry for this file, metadata and
+                      header are taken from it and the image file is only loaded when needed
+        :param header: NIFTI header of a file that has just been written. If given, header and
+                       metadata are used as they are and none of the files are read
+        :param metadata: Metadata of a file that has just been written, used with header
         """
         self.fpath = os.path.abspath(os.path.normpath(fpath))
         self.dirname, self.fname = os.path.split(self.fpath)
@@ -37,8 +412,21 @@ class ImageFile:
         self.json_fpath = self.fpath.replace(".nii.gz", ".json").replace(".nii", ".json")
         self.bval_fpath = self.fpath.replace(".nii.gz", ".bval").replace(".nii", ".bval")
         self.bvec_fpath = self.fpath.replace(".nii.gz", ".bvec").replace(".nii", ".bvec")
-        self.nii = nib.load(self.fpath)
+        self._nii, self._header, self._hash = None, None, None
         self.metadata = {}
+        self._stats = self._file_stats()
+        if header is not None:
+            self._header = header
+            self.metadata = metadata if metadata is not None else {}
+            return
+        entry = index.get(self.fpath, self._stats) if index is not None else None
+        if entry is not None:
+            self._from_index_entry(entry)
+            if warn_json and self._stats[1] is None:
+                LOG.warn(f"No .JSON metadata for NIFTI file {self.fpath} - metadata matching may not work")
+            return
+
+        self.nii = nib.load(self.fpath)
         if os.path.exists(self.json_fpath):
             try:
                 with open(self.json_fpath, "r", encoding="utf-8", errors="ignore") as f:
@@ -55,8 +443,82 @@ class ImageFile:
         if os.path.exists(self.bvec_fpath):
             self.metadata["bvec"] = np.atleast_1d(np.loadtxt(self.bvec_fpath))
 
+    def _file_stats(self):
+        """
+        :return: List of [size, modification time] for the image, JSON, bval and bvec files. None for missing files
+        """
+        stats = []
+        for fpath in (self.fpath, self.json_fpath, self.bval_fpath, self.bvec_fpath):
+            try:
+                stat = os.stat(fpath)
+                stats.append([stat.st_size, stat.st_mtime_ns])
+            except OSError:
+                stats.append(None)
+        return stats
+
+    def index_entry(self):
+        """
+        :return: JSON-serializable dictionary of scanned metadata for storing in a NiftiIndex
+        """
+        entry = {
+            "fpath": self.fpath,
+            "stats": self._stats,
+            "header": base64.b64encode(self.header.binaryblock).decode("ascii"),
+            "metadata": {k: v for k, v in self.metadata.items() if k not in ("bval", "bvec")},
+            "hash": self._hash,
+        }
+        for key in ("bval", "bvec"):
+            if key in self.metadata:
+                entry[key] = self.metadata[key].tolist()
+        return entry
+
+    def _from_index_entry(self, entry):
+        binaryblock = base64.b64decode(entry["header"])
+        if len(binaryblock) == nib.Nifti2Header.sizeof_hdr:
+            self._header = nib.Nifti2Header(binaryblock)
+        else:
+            self._header = nib.Nifti1Header(binaryblock)
+        self._hash = entry["hash"]
+        self.metadata = dict(entry["metadata"])
+        for key in ("bval", "bvec"):
+            if key in entry:
+                self.metadata[key] = np.atleast_1d(np.array(entry[key]))
+
+    @property
+    def metadata(self):
+        """
+        Metadata dictionary, typically from the JSON sidecar
+        """
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self._metadata = _Metadata(metadata)
 
-    def save_derived(self, data, fname, copy_json=True, copy_bdata=False):
+    @property
+    def nii(self):
+        """
+        Nibabel image, loaded on first use if metadata came from an index
+        """
+        if self._nii is None:
+            self._nii = nib.load(self.fpath)
+        return self._nii
+
+    @nii.setter
+    def nii(self, nii):
+        self._nii = nii
+        ImageFile.data_cache.release([self])
+
+    @property
+    def header(self):
+        """
+        NIFTI header
+        """
+        if self._nii is None and self._header is not None:
+            return self._header
+        return self.nii.header
+
+    def save_derived(self, data, fname, copy_json=True, copy_bdata=False, writer=None):
         """
         Save 'derived' data which should inherit the affine/header from this
         data file
@@ -64,20 +526,118 @@ class ImageFile:
         :param data: Numpy array which must be compatible with the original data shape
         :param fname: Output filename including Nifti extension
         :param copy_json: If True, copy the JSON metadata from the original file too
+        :param writer: Optional OutputWriter to write the files in the background
+        :return: ImageFile for the saved file, or a Future returning it if writer was given
         """
         nii = nib.Nifti1Image(data, self.affine, self.nii.header)
-        nii.to_filename(fname)
+        sidecars = self._sidecars(fname, copy_json, copy_bdata)
+        if writer is not None:
+            return writer.submit(_write_derived, nii, fname, sidecars, nbytes=data.nbytes, output=fname)
+        return _write_derived(nii, fname, sidecars)
+
+    def save_vols(self, fname, vols=None, copy_json=True, copy_bdata=False, scale=None, writer=None):
+        """
+        Save all or selected volumes, inheriting the affine/header from this file
+
+        The data is read, and written, one volume at a time (one slice for 3D
+        data) so only about one volume is in memory however large the file is.
+        Stored values are written unchanged with any scale factor folded into
+        scl_slope/scl_inter.
+
+        If the data has been modified in memory, or scale is zero, the scaled
+        data is saved using save_derived() instead
+
+        :param fname: Output filename including Nifti extension
+        :param vols: Sequence of volume indices in the last dimension, or None for all of the data.
+                     A single selected volume is saved as a 3D image
+        :param copy_json: If True, copy the JSON metadata from the original file too
+        :param scale: Optional factor to scale the data by
+        :param writer: Optional OutputWriter to write the files in the background
+        :return: ImageFile for the saved file, or a Future returning it if writer was given
+        """
+        scaling = self._raw_scaling()
+        if scaling is None or scale == 0 or len(self.shape) < 3:
+            data = self.decoded_data if vols is None else self.get_vols(vols)
+            if vols is not None and len(vols) == 1:
+                data = np.squeeze(data, axis=-1)
+            if scale is not None:
+                data = scale * data
+            return self.save_derived(data, fname, copy_json, copy_bdata, writer=writer)
+
+        slope, inter = scaling
+        if scale is not None:
+            slope, inter = slope * scale, inter * scale
+        if vols is None:
+            vols = list(range(self.shape[-1]))
+            out_shape = self.shape
+        elif len(vols) == 1:
+            out_shape = self.shape[:-1]
+        else:
+            out_shape = self.shape[:-1] + (len(vols),)
+        header = nib.Nifti1Header.from_header(self.nii.header)
+        header.set_data_shape(out_shape)
+        header.set_data_offset(0)
+        header.set_slope_inter(slope, inter)
+
+        dataobj = self.nii.dataobj
+        chunks = self._iter_raw_vols(dataobj, list(vols), ImageFile.data_cache.get(self, raw=True))
+        sidecars = self._sidecars(fname, copy_json, copy_bdata)
+        if writer is not None:
+            nbytes = int(np.prod(self.shape[:-1])) * self.dtype.itemsize
+            return writer.submit(_write_streamed, header, chunks, fname, sidecars, nbytes=nbytes, output=fname)
+        return _write_streamed(header, chunks, fname, sidecars)
+
+    def can_copy_file(self, fname):
+        """
+        :param fname: Output filename including Nifti extension
+        :return: True if the image file can be copied to fname unchanged by copy_file(),
+                 rather than being decoded and saved again
+        """
+        return (
+            # Data must not have been modified or reshaped since it was loaded
+            (self._nii is None or self._nii.get_filename() == self.fpath)
+            and fname.endswith(".nii.gz") == self.fpath.endswith(".nii.gz")
+            and len(self.shape) >= 3
+            and not isinstance(self.header, nib.Nifti2Header)
+            # Only BGZF files can be given a block offset index
+            and (not ImageFile.write_gzip_index or not fname.endswith(".gz") or bgzf.is_bgzf(self.fpath))
+        )
+
+    def copy_file(self, fname, copy_json=True, copy_bdata=False, writer=None):
+        """
+        Save a copy of this file without decoding the image data
+
+        The file bytes are copied as they are, using an in-kernel copy or reflink
+        where the filesystem supports it. Only the sidecar files are written
+        again. Use can_copy_file() first to check that the output would be the
+        same as from save_derived()
+
+        :param fname: Output filename including Nifti extension
+        :param copy_json: If True, copy the JSON metadata from the original file too
+        :param writer: Optional OutputWriter to copy the files in the background
+        :return: None, or a Future for the copy if writer was given
+        """
+        sidecars = self._sidecars(fname, copy_json, copy_bdata)
+        if writer is not None:
+            return writer.submit(_write_copy, self.fpath, fname, sidecars, output=fname)
+        _write_copy(self.fpath, fname, sidecars)
+
+    def _sidecars(self, fname, copy_json, copy_bdata):
+        """
+        :return: Sequence of (path, content) for the sidecar files to save with a copy of this file.
+                 Content is JSON text or an array of bval/bvec data
+        """
+        sidecars = []
         if copy_json and os.path.exists(self.json_fpath):
             new_json_fpath = fname.replace(".nii.gz", ".json").replace(".nii", ".json")
-            with open(new_json_fpath, 'w') as fp:
-                json.dump(self.metadata, fp, indent=4, default=lambda o: '<not serializable>')
+            sidecars.append((new_json_fpath, json.dumps(self.metadata, indent=4, default=lambda o: '<not serializable>')))
         if copy_bdata and os.path.exists(self.bval_fpath):
             new_bval_fpath = fname.replace(".nii.gz", ".bval").replace(".nii", ".bval")
-            np.savetxt(new_bval_fpath, self.bval)
+            sidecars.append((new_bval_fpath, self.bval))
         if copy_bdata and os.path.exists(self.bvec_fpath):
             new_bvec_fpath = fname.replace(".nii.gz", ".bvec").replace(".nii", ".bvec")
-            np.savetxt(new_bvec_fpath, self.bvec)
-        return ImageFile(fname, warn_json=False)
+            sidecars.append((new_bvec_fpath, self.bvec))
+        return sidecars
 
     def save(self, fname):
         """
@@ -87,18 +647,8 @@ class ImageFile:
         """
         if not fname.endswith(".nii") and not fname.endswith(".nii.gz"):
             fname += ".nii.gz"
-        self.nii.to_filename(fname)
-        if os.path.exists(self.json_fpath):
-            new_json_fpath = fname.replace(".nii.gz", ".json").replace(".nii", ".json")
-            with open(new_json_fpath, 'w') as fp:
-                json.dump(self.metadata, fp, indent=4, default=lambda o: '<not serializable>')
-
-        if os.path.exists(self.bval_fpath):
-            new_bval_fpath = fname.replace(".nii.gz", ".bval").replace(".nii", ".bval")
-            np.savetxt(new_bval_fpath, self.bval)
-        if os.path.exists(self.bvec_fpath):
-            new_bvec_fpath = fname.replace(".nii.gz", ".bvec").replace(".nii", ".bvec")
-            np.savetxt(new_bvec_fpath, self.bvec)
+        _save_nifti(self.nii, fname, index=ImageFile.write_gzip_index)
+        _write_sidecars(self._sidecars(fname, copy_json=True, copy_bdata=True))
 
     def __getattr__(self, attr):
         """
@@ -135,48 +685,17 @@ class ImageFile:
 
         :return: True the file matches.
         """
-        for key, value in kwargs.items():
-            myval = getattr(self, key, None)
-            LOG.debug(f"Checking for {key} ({myval}) {match_type} {value} in {self.fname}")
-            if value is None and myval is None:
-                match = True
-            elif value is None and myval is not None:
-                match = False
-            elif myval is None:
-                match = False
-            elif isinstance(myval, float) and isinstance(value, float):
-                match = math.abs(value - myval) < FLOAT_TOL
-            elif isinstance(myval, int) and isinstance(value, int):
-                match = value == myval
-            elif isinstance(myval, (list, tuple)) and isinstance(value, (list, tuple)):
-                match = np.allclose(list(value), list(myval))
-            elif match_type == "contains" and isinstance(myval, str) and isinstance(value, str):
-                match = _norm(value) in _norm(myval)
-            elif match_type == "contains" and isinstance(myval, list) and isinstance(value, str):
-                match = _norm(value) in [_norm(v) for v in myval]
-            elif match_type == "contains" and isinstance(myval, str) and isinstance(value, list):
-                match = any([_norm(v) in _norm(myval) for v in value])
-            elif match_type == "contains" and isinstance(myval, list) and isinstance(value, list):
-                myval = [_norm(v) for v in myval]
-                match = any([_norm(v) in myval for v in value])
-            elif match_type == "exact" and isinstance(myval, str) and isinstance(value, str):
-                match = _norm(value) == _norm(myval)
-            elif match_type == "exact" and isinstance(myval, list) and isinstance(value, str):
-                match = _norm(value) in [_norm(v) for v in myval]
-            elif match_type == "exact" and isinstance(myval, str) and isinstance(value, list):
-                match = any([_norm(v) == _norm(myval) for v in value])
-            elif match_type == "exact" and isinstance(myval, list) and isinstance(value, list):
-                myval = [_norm(v) for v in myval]
-                match = any([_norm(v) in myval for v in value])
-            elif match_type == "len" and isinstance(value, int):
-                match = len(myval) == value
-            else:
-                raise NotImplementedError(f"Don't know how to test type {type(myval)} {match_type} {type(value)}")
-
-            if not match:
-                LOG.debug("No match")
+        debug = LOG.isEnabledFor(logging.DEBUG)
+        for criterion in _compile_criteria(match_type, kwargs):
+            myval = getattr(self, criterion.key, None)
+            if debug:
+                LOG.debug(f"Checking for {criterion.key} ({myval}) {match_type} {criterion.value} in {self.fname}")
+            if not criterion(myval):
+                if debug:
+                    LOG.debug("No match")
                 return False
-        LOG.debug("File matched")
+        if debug:
+            LOG.debug("File matched")
         return True
 
     @property
@@ -191,14 +710,14 @@ class ImageFile:
         """
         Underlying data array shape
         """
-        return self.nii.shape
+        return self.header.get_data_shape()
 
     @property
     def shape3d(self):
         """
         Underlying data array shape ignoring any dimensions beyond the first 3
         """
-        return self.nii.shape[:3]
+        return self.shape[:3]
     
     @property
     def nvols(self):
@@ -237,7 +756,7 @@ class ImageFile:
         """
         4x4 voxel->world affine transform matrix
         """
-        return self.nii.header.get_best_affine()
+        return self.header.get_best_affine()
 
     @property
     def affinedata(self):
@@ -253,7 +772,7 @@ class ImageFile:
         """
         Voxel size in um integers, designed to be comparable and hashable
         """
-        voxel_sizes = self.nii.header.get_zooms()
+        voxel_sizes = self.header.get_zooms()
         return tuple([int(v * 1000) for v in voxel_sizes])
 
     @property
@@ -267,10 +786,28 @@ class ImageFile:
     def data(self):
         """
         Underlying data array, always at least 3D
+
+        This is a copy which the caller may modify. The decoded data is kept in the
+        shared data cache, so reading it again does not decode the file again
         """
-        data = np.array(self.nii.get_fdata())
-        while data.ndim < 3:
-            data = data[..., np.newaxis]
+        return np.array(self.decoded_data)
+
+    @property
+    def decoded_data(self):
+        """
+        Underlying data array, always at least 3D, as kept in the shared data cache
+
+        This avoids the copy made by data, but the array is read-only. Use
+        release_data() when it is no longer needed
+        """
+        data = ImageFile.data_cache.get(self)
+        if data is None:
+            # Do not let nibabel keep its own copy - the data cache manages memory
+            data = np.asanyarray(self._read_dataobj(), dtype=np.float64)
+            while data.ndim < 3:
+                data = data[..., np.newaxis]
+            data.flags.writeable = False
+            ImageFile.data_cache.put(self, data)
         return data
 
     @data.setter
@@ -282,18 +819,196 @@ class ImageFile:
             data = data[..., np.newaxis]
         self.nii = nib.Nifti1Image(data, self.affine, self.nii.header)
 
+    @property
+    def raw_data(self):
+        """
+        Underlying data array as stored in the file, always at least 3D
+
+        This is in the stored data type, without scl_slope/scl_inter applied, so it
+        can be written out again by save_vols() without conversion.
+        If the image data has been modified in memory it is the same as data.
+        The array is kept in the shared data cache so it is read-only
+        """
+        data = ImageFile.data_cache.get(self, raw=True)
+        if data is None:
+            dataobj = self._read_dataobj()
+            if nib.is_proxy(dataobj):
+                data = np.asanyarray(dataobj.get_unscaled())
+            else:
+                data = np.asanyarray(dataobj)
+            while data.ndim < 3:
+                data = data[..., np.newaxis]
+            data.flags.writeable = False
+            ImageFile.data_cache.put(self, data, raw=True)
+        return data
+
+    def _read_dataobj(self):
+        """
+        :return: nibabel data object for reading all of the image data. BGZF
+                 files are decompressed in parallel into memory first
+        """
+        dataobj = self.nii.dataobj
+        if nib.is_proxy(dataobj) and self.fpath.endswith(".gz") and bgzf.is_bgzf(self.fpath):
+            data = bgzf.read(self.fpath)
+            if data is not None:
+                return type(self.nii).from_bytes(data).dataobj.reshape(dataobj.shape)
+        return dataobj
+
+    def _raw_scaling(self):
+        """
+        :return: Tuple of (slope, inter) that applies to raw_data, or None if the data is in memory
+        """
+        dataobj = self.nii.dataobj
+        if nib.is_proxy(dataobj):
+            return dataobj.slope, dataobj.inter
+        return None
+
+    def get_vols(self, vols):
+        """
+        Get data for selected volumes only
+
+        Unless the full data is already in memory, only the requested volumes
+        are read via the nibabel array proxy. For uncompressed files this is a
+        memory-mapped read of just those volumes
+
+        :param vols: Sequence of volume indices in the last dimension
+        :return: Array containing the selected volumes in the last dimension
+        """
+        data = ImageFile.data_cache.get(self)
+        if data is not None:
+            return data[..., list(vols)]
+        dataobj = self.nii.dataobj
+        indexed_vols = self._read_indexed_vols(dataobj, vols) if nib.is_proxy(dataobj) else None
+        if indexed_vols is not None:
+            slope, inter = np.asanyarray(dataobj.slope), np.asanyarray(dataobj.inter)
+            return np.stack(
+                [np.asarray(apply_read_scaling(v, slope, inter), dtype=np.float64) for v in indexed_vols],
+                axis=-1,
+            )
+        return np.stack(
+            [np.asarray(dataobj[..., v], dtype=np.float64) for v in vols],
+            axis=-1,
+        )
+
+    def _read_indexed_vols(self, dataobj, vols):
+        """
+        Read raw data for selected volumes using a BGZF block offset index
+
+        Only the compressed blocks containing the volumes are decompressed
+
+        :param dataobj: nibabel array proxy for this file
+        :return: List of raw volume arrays, or None if the file has no usable index
+        """
+        offsets = self._read_block_index()
+        if offsets is None:
+            return None
+        try:
+            return [self._read_indexed_vol(dataobj, offsets, v) for v in vols]
+        except (OSError, ValueError, zlib.error):
+            LOG.warn(f" - Block offset index for {self.fname} could not be used - reading without it")
+            return None
+
+    def _read_block_index(self):
+        """
+        :return: BGZF block offset index for this file, or None if it has no usable index
+        """
+        index_fpath = self.fpath + bgzf.INDEX_EXT
+        if not os.path.exists(index_fpath) or not bgzf.is_bgzf(self.fpath):
+            return None
+        try:
+            return bgzf.read_index(index_fpath)
+        except (OSError, ValueError):
+            LOG.warn(f" - Block offset index {index_fpath} could not be read - reading {self.fname} without it")
+            return None
+
+    def _read_indexed_vol(self, dataobj, offsets, vol):
+        """
+        Read raw data for a single volume using a BGZF block offset index
+
+        :param dataobj: nibabel array proxy for this file
+        :param offsets: Block offset index as returned by _read_block_index()
+        :return: Raw volume array
+        """
+        dtype = np.dtype(dataobj.dtype)
+        vol_shape = dataobj.shape[:-1]
+        vol_bytes = int(np.prod(vol_shape)) * dtype.itemsize
+        data = bgzf.read_range(self.fpath, offsets, int(dataobj.offset) + vol * vol_bytes, vol_bytes)
+        return np.frombuffer(data, dtype=dtype).reshape(vol_shape, order="F")
+
+    def _iter_raw_vols(self, dataobj, vols, cached=None):
+        """
+        Generate raw data for selected volumes one at a time
+
+        For 3D data the 'volumes' are slices. The data is read from the file as
+        it is needed, so only one volume is in memory at once
+
+        :param dataobj: nibabel array proxy for this file
+        :param vols: Sequence of indices in the last dimension
+        :param cached: Raw data array if already in memory
+        """
+        if cached is not None:
+            for v in vols:
+                yield cached[..., v]
+            return
+        offsets = self._read_block_index()
+        first = None
+        if offsets is not None and vols:
+            try:
+                first = self._read_indexed_vol(dataobj, offsets, vols[0])
+            except (OSError, ValueError, zlib.error):
+                LOG.warn(f" - Block offset index for {self.fname} could not be used - reading without it")
+        if first is not None:
+            yield first
+            for v in vols[1:]:
+                yield self._read_indexed_vol(dataobj, offsets, v)
+        else:
+            # For compressed files, increasing volumes are read in a single pass through the
+            # file. Seeking back to an earlier volume decompresses from the start again
+            dtype = np.dtype(dataobj.dtype)
+            vol_shape = dataobj.shape[:-1]
+            vol_bytes = int(np.prod(vol_shape)) * dtype.itemsize
+            with ImageOpener(self.fpath) as f:
+                for v in vols:
+                    f.seek(int(dataobj.offset) + v * vol_bytes)
+                    yield np.frombuffer(f.read(vol_bytes), dtype=dtype).reshape(vol_shape, order="F")
+
+    def release_data(self):
+        """
+        Release decoded data for this image from memory
+        """
+        ImageFile.data_cache.release([self])
+        if self._nii is not None:
+            self._nii.uncache()
+
     @property
     def hash(self):
         """
         Hash code for underlying data array to determine if two images
         contain exactly the same underlying data
+
+        This reads the whole file so is only computed once
         """
-        hash_md5 = hashlib.md5()
-        with open(self.fpath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
+        if self._hash is None:
+            digest = hashlib.blake2b()
+            with open(self.fpath, "rb") as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            self._hash = digest.hexdigest()
+        return self._hash
 
-        return hash_md5.hexdigest()
+    @property
+    def filesize(self):
+        """
+        Size of the image file in bytes
+        """
+        return self._stats[0][0]
+
+    @property
+    def dtype(self):
+        """
+        Data type of the image as stored in the file
+        """
+        return self.header.get_data_dtype()
 
     def mdval(self, key, default=None, keep_case=False, replace_spaces=True):
         """
@@ -303,20 +1018,33 @@ class ImageFile:
         :param default: Value to retrun if not found
         :param keep_case: If False, string values are lowercased before being returned
         """
-        for k in self.metadata:
-            if _norm(k) == _norm(key):
-                key = k
-        val = self.metadata.get(key, default)
-        if isinstance(val, str) and not keep_case:
-            val = val.lower()
-        if isinstance(val, str) and replace_spaces:
-            val = val.replace(" ", "_")
-        if isinstance(val, list) and len(val) > 0 and isinstance(val[0], str) and not keep_case:
-            val = [v.lower() for v in val]
-        if isinstance(val, list) and len(val) > 0 and isinstance(val[0], str) and replace_spaces:
-            val = [v.replace(" ", "_") for v in val]
+        val = self.metadata.lookup(key, keep_case, replace_spaces)
+        if val is _MISSING:
+            return _format_mdval(default, keep_case, replace_spaces)
+        if isinstance(val, list):
+            # Formatted values are cached so callers get their own copy of lists
+            return list(val)
         return val
 
+    def reshape(self, shape):
+        """
+        Reinterpret the data with a different shape
+
+        This is for data where e.g. slices have been stored as volumes, or to
+        remove singleton dimensions. The data keeps its stored (Fortran) order so
+        nothing is read or copied - the file is still read lazily when the data
+        is needed, and outputs can still be written from the stored values
+
+        :param shape: New shape with the same number of voxels
+        """
+        dataobj = self.nii.dataobj
+        if nib.is_proxy(dataobj):
+            dataobj = dataobj.reshape(shape)
+        else:
+            dataobj = np.reshape(dataobj, shape, order="F")
+        self.nii = nib.Nifti1Image(dataobj, self.affine, self.nii.header)
+        return self
+
     def reorient2std(self):
         """
         Reorient the image to standard orientation
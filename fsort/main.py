@@ -24,6 +24,19 @@ def _setup_logging(args):
     handler.setFormatter(formatter)
     logging.getLogger().addHandler(handler)
 
+def _memory_size(value):
+    """
+    Parse a memory size such as 512M or 4G into bytes. Plain numbers are megabytes
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    value = value.strip().upper().rstrip("B")
+    try:
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(float(value) * units["M"])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid memory size: {value}")
+
 def run(config_fname):
     sys.argv.append(f"--config={config_fname}")
     main()
@@ -53,7 +66,15 @@ def main():
     parser.add_argument('--nifti-output', help='Path (relative to output) to store initial NIFTI converted files. If not specified, will use nifti')
     parser.add_argument("--skip-dcm2niix", help="Skip DCM2NIIX conversion where NIFTI dir already exists and contains files", action="store_true", default=False)
     parser.add_argument('--dcm2niix', help='One or more dcm2niix executables. Sorters can select which to use', nargs="*", default=["dcm2niix"])
+    parser.add_argument('--jobs', help='Number of DICOM folders to convert and NIFTI files to scan in parallel. Each DICOM folder is converted by all --dcm2niix executables together', type=int, default=1)
+    parser.add_argument('--dcm2niix-lazy', action="store_true", default=False, help='Only convert DICOMs using the first dcm2niix executable up front. Others are used only when a sorter selects their candidate set')
+    parser.add_argument('--dcm2niix-cache', help='Path to persistent cache of DICOM->NIFTI conversions. Only DICOM folders not already in the cache are converted')
+    parser.add_argument('--scratch-dir', help='Folder for intermediate NIFTI files, e.g. node-local storage. DICOMs are converted to uncompressed NIFTI in a subfolder of this and only final outputs are compressed')
+    parser.add_argument('--scratch-cleanup', choices=["keep", "delete", "archive"], default="keep", help='What to do with intermediate NIFTI files in --scratch-dir when finished. archive compresses them into the nifti subfolder of the output before deleting them')
     parser.add_argument('--dcm2niix-args', help='DCM2NIIX arguments for DICOM->NIFTI conversion', default="-m n -f %d_%q")
+    parser.add_argument('--compress-threads', type=int, help='Number of threads used to compress and decompress NIFTI files. If not given, all CPUs available to the process are used')
+    parser.add_argument('--gzip-index', action="store_true", default=False, help='Write a block offset index (.gzi) alongside each compressed output so single volumes can be read without decompressing the whole file')
+    parser.add_argument('--max-memory', type=_memory_size, help='Memory budget for decoded image data, e.g. 512M or 4G. Least recently used data is released when over budget. If not given, decoded data is kept until all sorters have run')
     parser.add_argument('--allow-no-vendor', action="store_true", default=False, help='If specified, process files even when no vendor can be identified')
     parser.add_argument('--allow-dupes', action="store_true", default=False, help='If specified, process files even when another file was found with same image contents')
     parser.add_argument('--overwrite', action="store_true", default=False, help='If specified, overwrite any existing output')
@@ -84,6 +105,10 @@ def main():
         parser.error("No subjects file given, but --subjects-file-has-dirs specified")
     if options.subject_idx is not None and options.subject_idx < 0:
         parser.error("SUBJECT_IDX must be >= 0")
+    if options.jobs < 1:
+        parser.error("JOBS must be >= 1")
+    if options.compress_threads is not None and options.compress_threads < 1:
+        parser.error("COMPRESS_THREADS must be >= 1")
 
     fsort = Fsort(options)
     if options.xnat_host:
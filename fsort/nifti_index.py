@@ -0,0 +1,66 @@
+"""
+FSORT: Persistent index of scanned NIFTI metadata
+"""
+import json
+import logging
+import os
+
+LOG = logging.getLogger(__name__)
+
+
+class NiftiIndex:
+    """
+    On-disk index of the metadata scanned from NIFTI files
+
+    Each entry holds the parsed JSON metadata, bval/bvec data, NIFTI header and
+    content hash for a file, along with the size and modification time of the
+    image and sidecar files when it was scanned. An entry is only used while
+    these still match, so files that have changed since they were indexed are
+    scanned again. The index is stored as one JSON object per line
+    """
+
+    def __init__(self, fpath):
+        """
+        :param fpath: Path to index file. Does not need to exist yet
+        """
+        self.fpath = fpath
+        self._entries = {}
+        if os.path.exists(fpath):
+            try:
+                with open(fpath, "r", encoding="utf-8") as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        self._entries[entry["fpath"]] = entry
+                LOG.info(f" - Loaded {len(self._entries)} entries from NIFTI index {fpath}")
+            except Exception:
+                LOG.warn(f"Failed to read NIFTI index {fpath} - all files will be rescanned")
+                self._entries = {}
+
+    def get(self, fpath, stats):
+        """
+        :param fpath: Absolute path to NIFTI file
+        :param stats: Current file stats as returned by ImageFile._file_stats()
+        :return: Index entry for fpath if it is up to date, otherwise None
+        """
+        entry = self._entries.get(fpath, None)
+        if entry is not None and entry["stats"] == stats:
+            return entry
+        return None
+
+    def update(self, files):
+        """
+        Add or refresh entries for a sequence of ImageFile instances
+        """
+        for file in files:
+            self._entries[file.fpath] = file.index_entry()
+
+    def save(self):
+        """
+        Write the index, dropping entries for files which no longer exist
+        """
+        tmp_fpath = self.fpath + ".tmp"
+        with open(tmp_fpath, "w", encoding="utf-8") as f:
+            for fpath, entry in self._entries.items():
+                if os.path.exists(fpath):
+                    f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_fpath, self.fpath)
@@ -0,0 +1,91 @@
+"""
+FSORT: Background writing of output files
+"""
+import collections
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+LOG = logging.getLogger(__name__)
+
+
+class OutputWriter:
+    """
+    Bounded pool of threads writing output files in the background
+
+    Jobs run in worker threads, but they are completed in the order they were
+    submitted and callbacks run in the submitting thread. So anything recorded on
+    completion, e.g. manifests, comes out the same as if the files had been written
+    one at a time. Failed jobs are recorded against their output and reported by
+    flush()
+
+    Submitting blocks while too many jobs are pending, or while the data held by
+    pending jobs would exceed the memory budget
+    """
+
+    def __init__(self, max_workers=1, max_bytes=None):
+        """
+        :param max_workers: Number of writer threads
+        :param max_bytes: Memory budget for data held by pending jobs. If None, only the number of jobs is limited
+        """
+        self.max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._max_pending = 4 * max_workers
+        self._pending = collections.deque()
+        self._nbytes = 0
+        self._errors = []
+
+    def submit(self, fn, *args, nbytes=0, output=None, **kwargs):
+        """
+        Queue a job, waiting for earlier jobs to complete first if the queue is full
+
+        :param nbytes: Size of the data held by the job until it completes
+        :param output: Path of the file written by the job, used to report failures
+        :return: Future for the job's result
+        """
+        while self._pending and (
+            len(self._pending) >= self._max_pending
+            or (self.max_bytes is not None and self._nbytes + nbytes > self.max_bytes)
+        ):
+            self._complete_next()
+        future = self._executor.submit(fn, *args, **kwargs)
+        self._pending.append((future, nbytes, output, None))
+        self._nbytes += nbytes
+        while self._pending and self._pending[0][0].done():
+            self._complete_next()
+        return future
+
+    def after(self, callback):
+        """
+        Call a function once all jobs submitted so far have completed
+        """
+        if not self._pending:
+            callback()
+        else:
+            future = Future()
+            future.set_result(None)
+            self._pending.append((future, 0, None, callback))
+
+    def flush(self):
+        """
+        Wait for all pending jobs to complete
+
+        If any job failed since the last flush, a RuntimeError naming the output of
+        the first failed job is raised here. Any other failures are logged
+        """
+        while self._pending:
+            self._complete_next()
+        errors, self._errors = self._errors, []
+        for output, exc in errors[1:]:
+            LOG.error(f"Failed to write {output}: {exc}")
+        if errors:
+            output, exc = errors[0]
+            raise RuntimeError(f"Failed to write {output}: {exc}") from exc
+
+    def _complete_next(self):
+        future, nbytes, output, callback = self._pending.popleft()
+        self._nbytes -= nbytes
+        exc = future.exception()
+        if exc is not None:
+            self._errors.append((output, exc))
+        if callback is not None:
+            callback()
@@ -7,6 +7,8 @@ import os
 
 import numpy as np
 
+from .image_file import ImageFile, match_files
+
 LOG = logging.getLogger(__name__)
 
 
@@ -21,6 +23,10 @@ class Sorter:
     REGEX = "regex"
     GLOB = "glob"
 
+    # OutputWriter for writing output files in the background. If None, outputs
+    # are written before save() returns. Set by Fsort
+    writer = None
+
     def __init__(self, name, **kwargs):
         """
         :param name: Unique name for this sorter within a given configuration file
@@ -31,6 +37,7 @@ class Sorter:
         self._candidates = []
         self._candidate_sets = {}
         self._using_set = 0
+        self._used_files = set()
         self.kwargs = kwargs
 
     def clear_selection(self):
@@ -73,15 +80,37 @@ class Sorter:
     @outdir.setter
     def outdir(self, outdir):
         self._outdir = outdir
-        with open(self.manifest_fname, "w") as mf:
-            mf.write(
-                "source\tdestination\tvolume\tscale_factor\tscale_const\tscale_attribute\tscale_inverse\n"
-            )
+        self._write_manifest(
+            [["source", "destination", "volume", "scale_factor", "scale_const", "scale_attribute", "scale_inverse"]],
+            mode="w",
+        )
 
     @property
     def manifest_fname(self):
         return os.path.join(self._outdir, "manifest.txt")
 
+    def _write_manifest(self, lines, mode="a"):
+        """
+        Write lines to the manifest once all outputs saved so far have been written
+
+        :param lines: Sequence of manifest lines, each a sequence of values
+        """
+        manifest_fname = self.manifest_fname
+        def _write():
+            with open(manifest_fname, mode) as mf:
+                for line in lines:
+                    mf.write("\t".join([str(v) for v in line]) + "\n")
+        self._after_writes(_write)
+
+    def _after_writes(self, fn):
+        """
+        Call fn once all outputs saved so far have been written
+        """
+        if Sorter.writer is None:
+            fn()
+        else:
+            Sorter.writer.after(fn)
+
     def process_files(self, file_sets, vendor, outdir):
         """
         Process a set of candidate files
@@ -98,6 +127,16 @@ class Sorter:
         else:
             self.run()
 
+    def release_data(self):
+        """
+        Mark decoded data for all files this sorter has saved from as no longer needed by it
+
+        The data stays in the shared data cache for any later sorters which use the
+        same files, until it is evicted to keep within the memory budget
+        """
+        ImageFile.data_cache.unpin(self._used_files)
+        self._used_files = set()
+
     def run(self):
         """
         This method must be implemented by the subclass to perform required matching operations
@@ -107,14 +146,11 @@ class Sorter:
         )
 
     def _match(self, match_type=CONTAINS, candidates=None, **kwargs):
-        matches = []
         if candidates is None:
             candidates = self._candidates
-        for file in candidates:
-            LOG.debug(f" - Match: checking {file.fname}")
-            if file.matches(match_type=match_type, **kwargs):
-                LOG.debug(f" - Matched {file.fname}")
-                matches.append(file)
+        matches = match_files(candidates, match_type, **kwargs)
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug(f" - Match: {len(matches)} of {len(candidates)} files matched {match_type} {kwargs}")
         return matches
 
     def add(self, match_type=CONTAINS, expected_number=None, **kwargs):
@@ -308,6 +344,31 @@ class Sorter:
             LOG.info(f" - Overall scaling of {f.fname} by factor {overall_factor}")
         return overall_factor
 
+    def split(self, vols, **kwargs):
+        """
+        Save several volume selections from each selected file
+
+        Each file is decoded once and every output is written from that, rather
+        than decoding the file again for each call to save()
+
+        :param vols: Mapping from output prefix to volume index or list of indices
+        :param kwargs: Other arguments as for save()
+        """
+        # Data is read raw unless scaling by zero as in save()
+        raw = self._scale_factor != 0
+        decoded = [file for file in self.selected if file.multivol]
+        ImageFile.data_cache.pin(decoded)
+        try:
+            for file in decoded:
+                if raw:
+                    file.raw_data
+                else:
+                    file.decoded_data
+            for prefix, vol in vols.items():
+                self.save(prefix, vol=vol, **kwargs)
+        finally:
+            ImageFile.data_cache.unpin(decoded)
+
     def save(
         self,
         prefix,
@@ -325,7 +386,8 @@ class Sorter:
 
         manifest = []
         num_matches = self.count(match_type, **matchers)
-        LOG.debug(f" - Unsorted files: {self.selected}")
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug(f" - Unsorted files: {self.selected}")
         n = 1
         if sort is not None:
             sorted_files = sorted(
@@ -334,7 +396,8 @@ class Sorter:
             )
         else:
             sorted_files = self.selected
-        LOG.debug(f" - Sorted files: {sorted_files} {self.selected}")
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug(f" - Sorted files: {sorted_files} {self.selected}")
         for file in sorted_files:
             if file.matches(match_type=match_type, **matchers):
                 if num_matches > 1:
@@ -355,26 +418,27 @@ class Sorter:
                     os.symlink(file.fpath, fpath)
                     os.symlink(file.json_fpath, json_fpath)
                 else:
-                    fdata = file.data
-                    if fdata.ndim > 3 and vol is not None:
+                    if file not in self._used_files:
+                        ImageFile.data_cache.pin([file])
+                        self._used_files.add(file)
+                    if self._scale_factor is not None:
+                        sf = self._get_scale_factor(file)
+                    whole_file = len(file.shape) <= 3 or vol is None
+                    if sf in (None, 1.0) and whole_file and file.can_copy_file(fpath):
+                        # Output is the unmodified source file
+                        file.copy_file(fpath, copy_bdata=True, writer=Sorter.writer)
+                    elif whole_file:
+                        file.save_vols(fpath, copy_bdata=True, scale=sf, writer=Sorter.writer)
+                    else:
                         if isinstance(vol, int):
                             vol = [vol]
-                        if max(vol) >= fdata.shape[-1]:
+                        if max(vol) >= file.shape[-1]:
                             raise ValueError(
-                                f"Attempting to select volume {vol} but data from {file.fname} only has {fdata.shape[-1]} volumes"
+                                f"Attempting to select volume {vol} but data from {file.fname} only has {file.shape[-1]} volumes"
                             )
-                        fdata_new = np.zeros(
-                            list(fdata.shape[:3]) + [len(vol)], dtype=fdata.dtype
-                        )
-                        for idx, v in enumerate(vol):
-                            fdata_new[..., idx] = fdata[..., v]
-                        fdata = fdata_new
-                        if len(vol) == 1:
-                            fdata = np.squeeze(fdata, axis=3)
-                    if self._scale_factor is not None:
-                        sf = self._get_scale_factor(file)
-                        fdata = sf * fdata
-                    file.save_derived(fdata, fpath, copy_bdata=True)
+                        file.save_vols(fpath, vols=vol, copy_bdata=True, scale=sf, writer=Sorter.writer)
+                    if Sorter.writer is not None:
+                        self._after_writes(lambda fname=fname: LOG.info(f" - Saved {fname}"))
                 manifest.append(
                     (
                         file.fname,
@@ -388,6 +452,4 @@ class Sorter:
                 )
                 n += 1
 
-        with open(self.manifest_fname, "a") as mf:
-            for line in manifest:
-                mf.write("\t".join([str(v) for v in line]) + "\n")
+        self._write_manifest(manifest)
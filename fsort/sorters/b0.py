@@ -70,8 +70,7 @@ class B0TwoEchos(Sorter):
                     LOG.info(" - Found 3-volume files")
                     self.group("echotime", allow_none=False)
                     select_one()
-                    self.save("b0_real_echo", sort="echotime", vol=1)
-                    self.save("b0_imag_echo", sort="echotime", vol=2)
+                    self.split({"b0_real_echo": 1, "b0_imag_echo": 2}, sort="echotime")
             elif not have_real or not have_imag:
                 LOG.warn("Could not find both real and imaginary parts - data incomplete")
 
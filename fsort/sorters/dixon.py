@@ -17,9 +17,7 @@ class MDixon(Sorter):
         if self.have_files():
             LOG.info(" - Found 3-volume mDIXON data")
             self.select_latest()
-            self.save("water", vol=0)
-            self.save("fat", vol=1)
-            self.save("fat_fraction", vol=2)
+            self.split({"water": 0, "fat": 1, "fat_fraction": 2})
             self.clear_selection()
             self.add(seriesdescription=self._inc, imagetype="T2", nvols=1)
             if self._exc:
@@ -3,8 +3,6 @@ Sorters for T1 data
 """
 import logging
 
-import numpy as np
-
 from fsort.sorter import Sorter
 
 LOG = logging.getLogger(__name__)
@@ -128,8 +126,7 @@ class T1MolliMapOrRaw(Sorter):
         self.group("affinedata")
         self.select_latest()
         LOG.info(f" - Found {nvols}-volume data from Philips - taking volume {map_vol} for T1 map, {conf_vol} for confidence")
-        self.save("t1_map", vol=map_vol)
-        self.save("t1_conf", vol=conf_vol)
+        self.split({"t1_map": map_vol, "t1_conf": conf_vol})
 
     def run_ge(self):
         self.add(seriesdescription="t1map", manufacturersmodelname="orchestra")
@@ -138,11 +135,7 @@ class T1MolliMapOrRaw(Sorter):
             # Slices are wrongly coded as separate volumes
             self.select_latest()
             img = self.selected[0]
-            shape = [img.shape[0], img.shape[1], img.nvols]
-            data = np.zeros(shape, dtype=img.data.dtype)
-            for vol in range(img.nvols):
-                data[..., vol] = np.squeeze(img.data[..., vol])
-            img.data = data
+            img.reshape([img.shape[0], img.shape[1], img.nvols])
             self.save("t1_map")
             self.save("t1_conf")
             return
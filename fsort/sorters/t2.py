@@ -51,8 +51,7 @@ class T2(Sorter):
                     LOG.info(f" - {num_echos+1} volumes found - removing last to discard T2 MAP image")
 
             if self.have_files():
-                for vol in range(num_echos):
-                    self.save(f"t2_e{vol+1}", vol=vol)
+                self.split({f"t2_e{vol+1}": vol for vol in range(num_echos)})
                 return True
 
         LOG.info(f" - Not found - Looking for T2 mapping data in {num_echos} or {num_echos+1} single-volume sets")
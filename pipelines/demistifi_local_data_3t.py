@@ -40,29 +40,16 @@ class Dixon(Sorter):
             self.select_latest()
             if "ACLAIM_004" in self.outdir:
                 LOG.info(" - Applying hack for ACLAIM_004 where order is different for some reason")
-                self.save("water", vol=4)
-                self.save("ip", vol=2)
-                self.save("op", vol=3)
-                self.save("fat", vol=0)
-                self.save("fat_fraction", vol=1)
-                self.save("t2star", vol=5)
+                self.split({"water": 4, "ip": 2, "op": 3, "fat": 0, "fat_fraction": 1, "t2star": 5})
             else:
-                self.save("water", vol=0)
-                self.save("ip", vol=1)
-                self.save("op", vol=2)
-                self.save("fat", vol=3)
-                self.save("fat_fraction", vol=4)
-                self.save("t2star", vol=5)
+                self.split({"water": 0, "ip": 1, "op": 2, "fat": 3, "fat_fraction": 4, "t2star": 5})
             return
 
         elif num_files_by_vols[4] > 0:
             LOG.info(" - Found 4-volume mDIXON data")
             self.add_dixon(nvols=4)
             self.select_latest()
-            self.save("water", vol=0)
-            self.save("fat", vol=1)
-            self.save("fat_fraction", vol=2)
-            self.save("t2star", vol=3)
+            self.split({"water": 0, "fat": 1, "fat_fraction": 2, "t2star": 3})
             return
 
         else:
@@ -115,9 +102,7 @@ class Dixon(Sorter):
                     self.clear_selection()
                     self.add_dixon(nvols=3)
                     self.select_latest()
-                    self.save("water", vol=0)
-                    self.save("fat", vol=1)
-                    self.save("fat_fraction", vol=2)
+                    self.split({"water": 0, "fat": 1, "fat_fraction": 2})
                 else:
                     self.add_dixon(nvols=1, fname="_e1a")
                     self.select_latest()